@@ -0,0 +1,124 @@
+"""
+Compares the .fmp codecs on a set of maps.
+
+    python benchmark.py [-n REPEAT] PATH...
+
+PATH is given as for convert.py. Every map is loaded once, then written
+and read back with each codec and level in CODECS. The table shows the
+time to encode and decode all the maps and their total size, taking the
+best of REPEAT runs.
+"""
+
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import time
+from os.path import basename, join, splitext
+
+from convert import find_maps, init_worker, legacy_indexes, tile_indexes
+from elona122 import Elona
+from elona_foobar import ElonaFoobar
+
+# (version, compression, level, tile encoding)
+CODECS = [
+    (1, "gzip", 9, "raw"),
+    (1, "gzip", 6, "raw"),
+    (1, "gzip", 1, "raw"),
+    (2, "none", None, "raw"),
+    (2, "none", None, "palette"),
+    (2, "zlib", 9, "raw"),
+    (2, "zlib", 9, "palette"),
+    (2, "zlib", 1, "raw"),
+    (2, "zlib", 1, "palette"),
+    (2, "lzma", 6, "raw"),
+    (2, "lzma", 0, "raw"),
+]
+
+
+def load_map(f):
+    if splitext(f)[1] == ".fmp":
+        return ElonaFoobar.read(f, tile_indexes)
+    return Elona.read(f, legacy_indexes)
+
+
+def decode(f):
+    foo = ElonaFoobar(f)
+    len(foo.tiles)
+    for layer in foo.iter_layers():
+        for obj in layer["objs"]:
+            pass
+
+
+def best_time(fn, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def benchmark(maps, repeat):
+    """
+    Returns (version, compression, level, tile encoding, encode s,
+    decode s, bytes) rows.
+    """
+    rows = list()
+    with tempfile.TemporaryDirectory() as out_dir:
+        outs = [join(out_dir, splitext(basename(f))[0] + ".fmp")
+                for f, m in maps]
+
+        for version, compression, level, tile_encoding in CODECS:
+            def encode():
+                for (f, m), out in zip(maps, outs):
+                    ElonaFoobar.write(m, out, tile_indexes, version,
+                                      compression, level, tile_encoding)
+
+            def decode_all():
+                for out in outs:
+                    decode(out)
+
+            encode_time = best_time(encode, repeat)
+            decode_time = best_time(decode_all, repeat)
+            size = sum(os.path.getsize(out) for out in outs)
+            rows.append((version, compression, level, tile_encoding,
+                         encode_time, decode_time, size))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare .fmp codecs on a set of maps.")
+    parser.add_argument("paths", nargs="+", metavar="PATH",
+                        help=".idx/.fmp map or directory of maps")
+    parser.add_argument("-n", "--repeat", type=int, default=3,
+                        help="runs per codec, the best one is shown")
+    args = parser.parse_args(argv)
+
+    # Set up as convert.py does. The plugins log a lot while reading and
+    # writing.
+    init_worker()
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        maps = [(f, load_map(f)) for f in find_maps(args.paths)]
+        rows = benchmark(maps, args.repeat)
+
+    print("{} maps".format(len(maps)))
+    print("{:>7} {:<6} {:>5} {:<7} {:>10} {:>10} {:>10}".format(
+        "version", "codec", "level", "tiles", "encode ms", "decode ms",
+        "bytes"))
+    for row in rows:
+        version, compression, level, tile_encoding, \
+            encode_time, decode_time, size = row
+        print("{:>7} {:<6} {:>5} {:<7} {:>10.1f} {:>10.1f} {:>10}".format(
+            version, compression, "-" if level == None else level,
+            tile_encoding, encode_time * 1000, decode_time * 1000, size))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
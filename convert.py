@@ -0,0 +1,362 @@
+"""
+Converts Elona maps to .fmp without running Tiled.
+
+    python convert.py [-o OUT_DIR] [-j JOBS] [-f] [-v] [--fmp-version N]
+                      [--compression CODEC] [--level N | --fast]
+                      [--tile-encoding raw|palette|chunked] PATH...
+
+Each PATH is a 1.22 .idx map (read together with its .map and .obj), an
+.fmp map to re-encode, or a directory of them. In a directory, an .fmp
+next to an .idx of the same name is that map's output, not another map
+to convert. Two maps that would be written to the same file are an
+error. Maps are loaded with the
+plugins' own readers into the in-memory model from lib/tiled_model.py
+and saved with ElonaFoobar.write. With -j, maps are spread over a pool
+of worker processes. --fmp-version 2 writes the container format, whose
+tile grid can be mapped and read in place when --compression is "none",
+stored as a palette and runs of cells with --tile-encoding palette, or
+in separately compressed chunks with --tile-encoding chunked.
+
+Each output directory keeps a manifest of what its maps were built from:
+the map's input files, the tilesets it uses and the converter's own
+source. Maps whose manifest entry is still current are skipped unless
+-f is given.
+"""
+
+import argparse
+import contextlib
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+from glob import glob
+from os.path import basename, dirname, exists, isdir, join, realpath, splitext
+
+from elona122 import Elona, getfile, probe_idx
+from elona_foobar import TILE_ENCODINGS, ElonaFoobar, probe_fmp
+from lib.fmp_container import ENCODINGS
+from lib.manifest import Manifest
+from lib.tilesets import preload_tilesets, scan_tilesets
+
+MAP_EXTENSIONS = (".idx", ".fmp")
+
+BASE_DIRECTORY = dirname(realpath(__file__))
+
+# Tileset indexes kept for the life of the process, so each worker
+# builds them once instead of once per map.
+legacy_indexes = dict()
+tile_indexes = dict()
+
+
+def find_maps(paths):
+    maps = list()
+    for path in paths:
+        if isdir(path):
+            filenames = sorted(os.listdir(path))
+            for filename in filenames:
+                name, ext = splitext(filename)
+                if not ext in MAP_EXTENSIONS:
+                    continue
+                # Converted in place, x.idx is written to x.fmp.
+                if ext == ".fmp" and name + ".idx" in filenames:
+                    continue
+                maps.append(join(path, filename))
+        else:
+            maps.append(path)
+    return maps
+
+
+def output_path(f, out_dir):
+    name = splitext(basename(f))[0] + ".fmp"
+    if out_dir == None:
+        return join(dirname(f), name)
+    return join(out_dir, name)
+
+
+def plan_outputs(maps, out_dir):
+    """
+    Returns (f, out) for each map. Raises if two maps would be written
+    to the same file.
+    """
+    planned = list()
+    sources = dict()
+    for f in maps:
+        out = output_path(f, out_dir)
+        other = sources.get(realpath(out))
+        if other != None:
+            raise Exception("{} and {} would both be written to {}".format(
+                other, f, out))
+        sources[realpath(out)] = f
+        planned.append((f, out))
+    return planned
+
+
+def convert_map(f, out, tmp_dir, options):
+    if splitext(f)[1] == ".fmp":
+        m = ElonaFoobar.read(f, tile_indexes)
+    else:
+        m = Elona.read(f, legacy_indexes)
+
+    # Write into tmp_dir, next to the output, and rename it into place,
+    # so a failed or interrupted conversion never leaves a partial map
+    # behind. The file keeps its final name while it is written, since
+    # gzip records the name in its header.
+    tmp = join(tmp_dir, basename(out))
+    try:
+        ElonaFoobar.write(m, tmp, tile_indexes, **options)
+        os.replace(tmp, out)
+    finally:
+        if exists(tmp):
+            os.remove(tmp)
+
+
+def converter_sources():
+    return sorted(glob(join(BASE_DIRECTORY, "*.py"))) + \
+        sorted(glob(join(BASE_DIRECTORY, "lib", "*.py")))
+
+
+def map_dependencies(f):
+    """
+    Returns the files the conversion of f reads, or None if f is not a
+    map that can be probed.
+    """
+    if splitext(f)[1] == ".fmp":
+        header = probe_fmp(f)
+        if header == None:
+            return None
+        inputs = [f]
+        atlas = header.mdata["atlas"]
+    else:
+        mdata = probe_idx(f)
+        if mdata == None:
+            return None
+        inputs = [f, getfile(f, "map")]
+        if exists(getfile(f, "obj")):
+            inputs.append(getfile(f, "obj"))
+        atlas = mdata.atlas
+
+    # Conservatively depend on every tileset that could be loaded.
+    tileset_directory = join(BASE_DIRECTORY, "Elona_foobar")
+    tilesets = [join(tileset_directory, "map%01i.tsx" % atlas)]
+    for path, name in scan_tilesets(tileset_directory):
+        tilesets.append(path)
+
+    return inputs + tilesets
+
+
+def map_key(manifest, f, options):
+    deps = map_dependencies(f)
+    if deps == None:
+        return None
+    try:
+        # The same inputs written with other options are another output.
+        salt = ",".join("{}={}".format(k, v)
+                        for k, v in sorted(options.items()))
+        return manifest.key(converter_sources() + deps, salt)
+    except OSError:
+        return None
+
+
+def init_worker():
+    # Converted maps are not edited, so only the tilesets they use are
+    # needed: preload the atlases, and find_tileset loads the rest once
+    # per worker as maps ask for them.
+    ElonaFoobar.lazy_tilesets = True
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        preload_tilesets(BASE_DIRECTORY, set())
+
+
+def init_pool_worker():
+    # Ctrl-C reaches the whole process group; leave it to the parent,
+    # which stops the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_worker()
+
+
+def run_job(job):
+    """
+    Converts one map. Returns (f, error), where error is None on success
+    and a message otherwise.
+    """
+    f, out, tmp_dir, verbose, options = job
+    try:
+        if verbose:
+            convert_map(f, out, tmp_dir, options)
+        else:
+            # The plugins log a lot while reading and writing.
+            with open(os.devnull, "w") as devnull, \
+                    contextlib.redirect_stdout(devnull):
+                convert_map(f, out, tmp_dir, options)
+    except Exception as e:
+        return (f, "{}: {}".format(type(e).__name__, e))
+    return (f, None)
+
+
+def convert_maps(maps, out_dir, verbose=False, jobs=1, force=False,
+                 options=None):
+    """
+    Converts each map that is not up to date, printing a line as each one
+    finishes. Returns the number of maps that failed and the number that
+    were skipped.
+    """
+    if options == None:
+        options = dict()
+
+    manifests = dict()
+    pending = list()
+    skipped = 0
+    for f, out in plan_outputs(maps, out_dir):
+        if not dirname(out) in manifests:
+            manifests[dirname(out)] = Manifest(dirname(out))
+        manifest = manifests[dirname(out)]
+
+        key = map_key(manifest, f, options)
+        if not force and key != None and manifest.is_current(f, out, key):
+            skipped += 1
+            continue
+        pending.append((f, out))
+
+    if len(pending) == 0:
+        return 0, skipped
+
+    # Maps are written into a scratch directory next to their output,
+    # one per output directory, which is removed here however the
+    # workers stop.
+    tmp_dirs = dict()
+    pool = None
+    failed = 0
+    finished = False
+    try:
+        work = list()
+        for f, out in pending:
+            if not dirname(out) in tmp_dirs:
+                tmp_dirs[dirname(out)] = tempfile.mkdtemp(
+                    prefix=".convert.", dir=dirname(out))
+            work.append(
+                (f, out, tmp_dirs[dirname(out)], verbose, options))
+
+        if jobs > 1 and len(work) > 1:
+            pool = multiprocessing.Pool(min(jobs, len(work)),
+                                        init_pool_worker)
+            results = pool.imap_unordered(run_job, work)
+        else:
+            init_worker()
+            results = map(run_job, work)
+
+        for done, (f, error) in enumerate(results, 1):
+            if error == None:
+                print("[{}/{}] {}".format(done, len(work), f))
+
+                # Keyed after the fact, as an .fmp converted in place is
+                # its own input.
+                out = output_path(f, out_dir)
+                manifest = manifests[dirname(out)]
+                key = map_key(manifest, f, options)
+                if key != None:
+                    manifest.record(f, out, key)
+            else:
+                failed += 1
+                print("[{}/{}] {} failed: {}".format(
+                    done, len(work), f, error), file=sys.stderr)
+        finished = True
+    finally:
+        if pool != None:
+            if finished:
+                pool.close()
+            else:
+                # Interrupted: stop the workers rather than wait for the
+                # maps they still have queued.
+                pool.terminate()
+            pool.join()
+        for tmp_dir in tmp_dirs.values():
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        for manifest in manifests.values():
+            manifest.save()
+    return failed, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert Elona maps to .fmp without Tiled.")
+    parser.add_argument("paths", nargs="+", metavar="PATH",
+                        help=".idx/.fmp map or directory of maps")
+    parser.add_argument("-o", "--out-dir",
+                        help="write maps here instead of next to their input")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of worker processes (0: one per CPU)")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="convert maps even if they are up to date")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="show the plugins' log output")
+    parser.add_argument("--fmp-version", type=int, choices=(1, 2),
+                        help=".fmp version to write (default: {})".format(
+                            ElonaFoobar.write_version))
+    parser.add_argument("--compression", choices=("gzip",) + tuple(ENCODINGS),
+                        help="gzip for version 1; none, zlib or lzma for 2")
+    parser.add_argument("--tile-encoding", choices=TILE_ENCODINGS,
+                        help="how version 2 stores the tile grid")
+    level = parser.add_mutually_exclusive_group()
+    level.add_argument("--level", type=int,
+                       help="compression level (default: the codec's)")
+    level.add_argument("--fast", action="store_const", dest="level",
+                       const=ElonaFoobar.FAST_LEVEL,
+                       help="compress with the fastest level")
+    args = parser.parse_args(argv)
+
+    # The same checks as ElonaFoobar.write, made once instead of failing
+    # every map.
+    version = args.fmp_version
+    if version == None:
+        version = ElonaFoobar.write_version
+    if version == 1 and not args.compression in (None, "gzip"):
+        parser.error(".fmp version 1 only supports gzip, not " +
+                     args.compression)
+    if version != 1 and args.compression == "gzip":
+        parser.error(".fmp version {} supports none, zlib or lzma, "
+                     "not gzip".format(version))
+    if version == 1 and not args.tile_encoding in (None, "raw"):
+        parser.error(".fmp version 1 only stores raw tiles, use "
+                     "--fmp-version 2 for --tile-encoding " +
+                     args.tile_encoding)
+
+    if args.out_dir != None:
+        os.makedirs(args.out_dir, exist_ok=True)
+
+    jobs = args.jobs
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+
+    options = dict()
+    if args.fmp_version != None:
+        options["version"] = args.fmp_version
+    if args.compression != None:
+        options["compression"] = args.compression
+    if args.level != None:
+        options["level"] = args.level
+    if args.tile_encoding != None:
+        options["tile_encoding"] = args.tile_encoding
+
+    maps = find_maps(args.paths)
+    try:
+        plan_outputs(maps, args.out_dir)
+    except Exception as e:
+        parser.error(str(e))
+
+    start = time.time()
+    failed, skipped = convert_maps(
+        maps, args.out_dir, args.verbose, jobs, args.force, options)
+    elapsed = time.time() - start
+
+    converted = len(maps) - failed - skipped
+    rate = converted / elapsed if elapsed > 0 else 0.0
+    print("converted {} of {} maps in {:.2f}s ({:.1f} maps/s), {} up to date".format(
+        converted, len(maps), elapsed, rate, skipped))
+    return 1 if failed > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
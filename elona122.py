@@ -5,12 +5,19 @@ Elona 1.22 map importer.
 from pprint import pprint
 import sys
 import re
-import tiled as T
-import os
-from os.path import dirname, splitext, basename, exists, realpath, join
-from lib import cpystruct
-from struct import pack, unpack
-from collections import namedtuple
+try:
+    import tiled as T
+except ImportError:
+    # Running outside of Tiled, e.g. from convert.py.
+    from lib import tiled_model as T
+from os.path import dirname, splitext, basename, exists, realpath
+from lib import cpystruct, probe
+from lib.fmp_codec import UINT, UINT_TYPECODE, uint_view
+from lib.tilesets import load_tilesets, find_tileset, tileset_index
+from array import array
+from collections import Counter
+from itertools import compress
+from operator import and_
 from math import floor
 import gzip
 
@@ -19,60 +26,140 @@ def getfile(path, ext):
     return splitext(path)[0] + "." + ext
 
 
-def load_tileset(m, filename):
-    print("load " + filename)
-    if not exists(filename):
-        raise Exception("cannot find tileset file " + filename)
-    tileset = T.loadTileset(filename)
-    if tileset == None:
-        raise Exception("failed to load " + filename)
-    m.addTileset(tileset)
+@probe.memoized
+def probe_idx(f):
+    """
+    Returns the MapData header of a 1.22 .idx file, or None if f is not
+    one. Only the start of the file is inflated.
+    """
+    mdata = MapData()
+    head = probe.read_head(f, len(mdata))
+    if head == None or len(head) < len(mdata):
+        return None
+    mdata.unpack(head)
+    if mdata.width == 0 or mdata.height == 0:
+        return None
+    return mdata
+
+
+class LegacyTileIndex():
+    """
+    legacy_id -> tile id and (legacy_id, tile) -> tile id for every tile
+    of one tileset, built in a single pass. Any key missing from it is
+    known not to be in the tileset. Like TileIndex, the first tile with
+    a key is the one found.
+    """
+
+    def __init__(self, tileset):
+        self.tileset = tileset
+        self.by_legacy = dict()
+        self.by_legacy_and_tile = dict()
+        for i in range(tileset.tileCount()):
+            tile = tileset.tileAt(i)
+            legacy_id = int(tile.propertyAsString("legacy_id"))
+            key = (legacy_id, tile.propertyAsString("tile"))
+            if not legacy_id in self.by_legacy:
+                self.by_legacy[legacy_id] = tile.id()
+            if not key in self.by_legacy_and_tile:
+                self.by_legacy_and_tile[key] = tile.id()
+
+    def find(self, ids, key):
+        tile_id = ids.get(key)
+        if tile_id == None:
+            return None
+        return self.tileset.tileAt(tile_id)
+
+
+def find_tile_by_legacy(tileset, legacy_id, indexes):
+    index = tileset_index(tileset, indexes, LegacyTileIndex)
+    return index.find(index.by_legacy, legacy_id)
+
+
+def find_tile_by_legacy_and_tile(tileset, legacy_id, indexes, tile_id):
+    index = tileset_index(tileset, indexes, LegacyTileIndex)
+    return index.find(index.by_legacy_and_tile, (legacy_id, tile_id))
+
+
+class LegacyRecords():
+    """
+    The records of one kind from a 1.22 .obj file, as parallel columns.
+    Iterating gives (legacy_id, x, y, param) for each record.
+    """
+
+    def __init__(self, legacy_id, x, y, param):
+        self.legacy_id = legacy_id
+        self.x = x
+        self.y = y
+        self.param = param
+
+    @classmethod
+    def select(cls, columns, mask):
+        """Takes the records of columns for which mask is true."""
+        return LegacyRecords(*[array(UINT_TYPECODE, compress(columns[name], mask))
+                               for name in ("legacy_id", "x", "y", "param")])
+
+    def __len__(self):
+        return len(self.legacy_id)
+
+    def __iter__(self):
+        return zip(self.legacy_id, self.x, self.y, self.param)
+
+
+def kind_mask(columns, kind):
+    # Records with a legacy_id of 0 are unused slots.
+    return list(map(and_, map(bool, columns["legacy_id"]),
+                    map(kind.__eq__, columns["kind"])))
+
+
+# Tile id of the cells whose legacy id has no tile.
+MISSING_TILE = 0xFFFFFFFF
 
 
-def load_tilesets(m, atlas, directory):
-    tileset_directory = join(directory, "Elona_foobar")
+class TileTranslation():
+    """
+    A 1.22 tile grid translated to one tileset. ids holds a tile id of
+    the tileset per cell, or MISSING_TILE; unknown maps each legacy id
+    that has no tile to the number of cells using it.
+    """
 
-    tile_atlas = join(tileset_directory, "map%01i.tsx" % atlas)
-    load_tileset(m, tile_atlas)
+    def __init__(self, width, height, ids, unknown):
+        self.width = width
+        self.height = height
+        self.ids = ids
+        self.unknown = unknown
 
-    for filename in os.listdir(tileset_directory):
-        if filename == "map0.tsx" or filename == "map1.tsx" or filename == "map2.tsx":
-            continue
-        if filename.endswith(".tsx"):
-            print("load " + filename)
-            atlas = join(tileset_directory, filename)
-            load_tileset(m, atlas)
+    def unique_ids(self):
+        return set(self.ids) - {MISSING_TILE}
 
+    def row(self, y):
+        return self.ids[y * self.width:(y + 1) * self.width]
 
-def find_tileset(m, data_type):
-    for i in range(m.tilesetCount()):
-        ts = m.tilesetAt(i).data()
-        if ts.name() == data_type:
-            return ts
-    return None
+    def describe_unknown(self):
+        return ", ".join("{} ({} cells)".format(legacy_id, count)
+                         for legacy_id, count in sorted(self.unknown.items()))
 
 
-def find_tile_by_legacy(tileset, legacy_id, cache):
-    if legacy_id in cache:
-        return tileset.tileAt(cache[legacy_id])
-    for i in range(tileset.tileCount()):
-        tile = tileset.tileAt(i)
-        if int(tile.propertyAsString("legacy_id")) == legacy_id:
-            cache[legacy_id] = tile.id()
-            return tile
-    return None
+def translate_tiles(width, height, tiles, tileset, indexes):
+    """
+    Translates the legacy ids of a tile grid to tile ids of tileset.
+    Each distinct legacy id is looked up once; the grid itself is a
+    table lookup per cell. Needs nothing from Tiled but the tileset.
+    """
+    table = dict()
+    for legacy_id in set(tiles):
+        tile = find_tile_by_legacy(tileset, legacy_id, indexes)
+        table[legacy_id] = MISSING_TILE if tile == None else tile.id()
 
+    ids = array(UINT_TYPECODE, map(table.__getitem__, tiles))
 
-def find_tile_by_legacy_and_tile(tileset, legacy_id, cache, tile_id):
-    if tile_id in cache:
-        return tileset.tileAt(cache[tile_id])
-    for i in range(tileset.tileCount()):
-        tile = tileset.tileAt(i)
-        if int(tile.propertyAsString("legacy_id")) == legacy_id:
-            if tile.propertyAsString("tile") == tile_id:
-                cache[tile_id] = tile.id()
-                return tile
-    return None
+    unknown = dict()
+    missing = [legacy_id for legacy_id, tile_id in table.items()
+               if tile_id == MISSING_TILE]
+    if len(missing) > 0:
+        counts = Counter(tiles)
+        for legacy_id in missing:
+            unknown[legacy_id] = counts[legacy_id]
+    return TileTranslation(width, height, ids, unknown)
 
 
 class Elona(T.Plugin):
@@ -86,10 +173,11 @@ class Elona(T.Plugin):
 
     @classmethod
     def supportsFile(cls, f):
-        return exists(getfile(f, "map"))
+        return exists(getfile(f, "map")) \
+            and probe_idx(getfile(f, "idx")) != None
 
     @classmethod
-    def read(cls, f):
+    def read(cls, f, indexes=None):
         print('Loading map at', f)
         el = Elona(f)
 
@@ -115,10 +203,12 @@ class Elona(T.Plugin):
         item_tileset = find_tileset(m, "core.item")
         chara_tileset = find_tileset(m, "core.chara")
 
-        layer_tiles = el.populate_tiles(tileset)
-        layer_objects = el.populate_objects(obj_tileset)
-        layer_items = el.populate_items(item_tileset)
-        layer_charas = el.populate_characters(chara_tileset)
+        if indexes == None:
+            indexes = dict()
+        layer_tiles = el.populate_tiles(tileset, indexes)
+        layer_objects = el.populate_objects(obj_tileset, indexes)
+        layer_items = el.populate_items(item_tileset, indexes)
+        layer_charas = el.populate_characters(chara_tileset, indexes)
 
         # have to pass ownership so can't add tileset before populating layer
         m.addLayer(layer_tiles)
@@ -152,99 +242,90 @@ class Elona(T.Plugin):
             mdata = MapData()
             mdata.unpack(fh)
         with gzip.open(map_, 'rb') as fh:
-            tiles = fh.read(mdata.width * mdata.height * 4)
-            tiles = unpack('I' * mdata.width * mdata.height, tiles)
-        items = []
-        charas = []
-        objs = []
-
+            tiles = uint_view(
+                fh.read(mdata.width * mdata.height * UINT.size), 0,
+                mdata.width * mdata.height)
+        # One column per field of the records: legacy_id, x, y, param
+        # and kind.
+        columns = LegacyObject.unpack_many(b"", columns=True)
         if exists(obj):
-            Character = namedtuple('Character', 'legacy_id x y')
-            Item = namedtuple('Item', 'legacy_id x y own_state')
-            Object = namedtuple(
-                'Object', 'legacy_id editor_tile actual_tile x y param')
-
             with gzip.open(obj, 'rb') as fh:
-                for i in range(400):
-                    dat = fh.read(5 * 4)
-                    if len(dat) == 0:
-                        print("not reading past " + str(i) + " objects")
-                        break
-                    dat = unpack("IIIII", dat)
-                    if dat[0] != 0:
-                        if dat[4] == 0:
-                            items.append(
-                                Item(legacy_id=dat[0], x=dat[1], y=dat[2], own_state=dat[3]))
-                        elif dat[4] == 1:
-                            charas.append(
-                                Character(legacy_id=dat[0], x=dat[1], y=dat[2]))
-                        elif dat[4] == 2:
-                            if dat[0] in self.cell_objs:
-                                objs.append(
-                                    Object(legacy_id=self.cell_objs[dat[0]][0],
-                                           editor_tile="core.1_" +
-                                           str(self.cell_objs[dat[0]][1]),
-                                           actual_tile="core.1_" +
-                                           str(self.cell_objs[dat[0]][2]),
-                                           x=dat[1],
-                                           y=dat[2],
-                                           param=dat[3]))
-
+                buf = fh.read(400 * len(LegacyObject()))
+            columns = LegacyObject.unpack_many(buf, columns=True)
+            if len(columns["kind"]) < 400:
+                print("not reading past " +
+                      str(len(columns["kind"])) + " objects")
+
+        items = LegacyRecords.select(columns, kind_mask(columns, 0))
+        charas = LegacyRecords.select(columns, kind_mask(columns, 1))
+        # Map objects without an editor equivalent are dropped.
+        objs = LegacyRecords.select(columns, list(map(
+            and_, kind_mask(columns, 2),
+            map(self.cell_objs.__contains__, columns["legacy_id"]))))
+
+        self.path = f
         self.mdata = mdata
         self.tiles = tiles
         self.items = items
         self.charas = charas
         self.objs = objs
 
-    def populate_tiles(self, t):
-        cache = dict()
+    def populate_tiles(self, t, indexes):
         l = T.Tiled.TileLayer(
             'Tiles', 0, 0, self.mdata.width, self.mdata.height)
+        translation = translate_tiles(
+            self.mdata.width, self.mdata.height, self.tiles, t, indexes)
+        if len(translation.unknown) > 0:
+            print("{}: no tile for legacy ids {}, left empty".format(
+                self.path, translation.describe_unknown()), file=sys.stderr)
+
+        # One cell per distinct tile, shared by every cell that uses it.
+        cells = dict()
+        for tile_id in translation.unique_ids():
+            cells[tile_id] = T.Tiled.Cell(t.tileAt(tile_id))
+
         for y in range(self.mdata.height):
+            row = translation.row(y)
             for x in range(self.mdata.width):
-                tpos = self.tiles[y * self.mdata.width + x]
-                ti = find_tile_by_legacy(t, tpos, cache)
-                if ti != None:
-                    l.setCell(x, y, T.Tiled.Cell(ti))
+                if row[x] != MISSING_TILE:
+                    l.setCell(x, y, cells[row[x]])
 
         return l
 
-    def populate_items(self, t):
-        cache = dict()
+    def populate_items(self, t, indexes):
         o = T.Tiled.ObjectGroup('Items', 0, 0)
-        for item in self.items:
-            ti = find_tile_by_legacy(t, item.legacy_id, cache)
+        for legacy_id, x, y, own_state in self.items:
+            ti = find_tile_by_legacy(t, legacy_id, indexes)
             if ti != None:
                 map_object = T.Tiled.MapObject("", "", T.qt.QPointF(
-                    item.x * 48, item.y * 48 + 48), T.qt.QSizeF(ti.width(), ti.height()))
-                map_object.setProperty("own_state", item.own_state)
+                    x * 48, y * 48 + 48), T.qt.QSizeF(ti.width(), ti.height()))
+                map_object.setProperty("own_state", own_state)
                 map_object.setCell(T.Tiled.Cell(ti))
                 o.addObject(map_object)
         return o
 
-    def populate_characters(self, t):
-        cache = dict()
+    def populate_characters(self, t, indexes):
         o = T.Tiled.ObjectGroup('Characters', 0, 0)
-        for chara in self.charas:
-            ti = find_tile_by_legacy(t, chara.legacy_id, cache)
+        for legacy_id, x, y, param in self.charas:
+            ti = find_tile_by_legacy(t, legacy_id, indexes)
             if ti != None:
                 map_object = T.Tiled.MapObject("", "", T.qt.QPointF(
-                    chara.x * 48, chara.y * 48 + 48), T.qt.QSizeF(ti.width(), ti.height()))
+                    x * 48, y * 48 + 48), T.qt.QSizeF(ti.width(), ti.height()))
                 map_object.setCell(T.Tiled.Cell(ti))
                 o.addObject(map_object)
         return o
 
-    def populate_objects(self, t):
-        cache = dict()
+    def populate_objects(self, t, indexes):
         o = T.Tiled.ObjectGroup('Map Objects', 0, 0)
-        for obj in self.objs:
+        for cell_obj, x, y, param in self.objs:
+            legacy_id, editor_tile, actual_tile = self.cell_objs[cell_obj]
             ti = find_tile_by_legacy_and_tile(
-                t, obj.legacy_id, cache, obj.editor_tile)
+                t, legacy_id, indexes, "core.1_" + str(editor_tile))
             if ti != None:
                 map_object = T.Tiled.MapObject("", "", T.qt.QPointF(
-                    obj.x * 48, obj.y * 48 + 48), T.qt.QSizeF(48, 48))
-                map_object.setProperty("param", obj.param)
-                map_object.setProperty("actual_tile", obj.actual_tile)
+                    x * 48, y * 48 + 48), T.qt.QSizeF(48, 48))
+                map_object.setProperty("param", param)
+                map_object.setProperty("actual_tile", "core.1_" + str(actual_tile))
                 map_object.setCell(T.Tiled.Cell(ti))
                 o.addObject(map_object)
         return o
@@ -252,3 +333,7 @@ class Elona(T.Plugin):
 
 class MapData(cpystruct.CpyStruct('uint width, height, atlas, regen, stairup;')):
     pass
+
+
+class LegacyObject(cpystruct.CpyStruct('uint legacy_id, x, y, param, kind;')):
+    pass
@@ -5,13 +5,23 @@ Elona Foobar map importer/exporter.
 from pprint import pprint
 import sys
 import re
-import tiled as T
-import os
-from os.path import dirname, splitext, basename, exists, join, realpath
-from lib import cpystruct
-from struct import pack, unpack
-from collections import namedtuple
+try:
+    import tiled as T
+except ImportError:
+    # Running outside of Tiled, e.g. from convert.py.
+    from lib import tiled_model as T
+from os.path import dirname, splitext, basename, realpath
+from lib import cpystruct, probe
+from lib.fmp_codec import BYTE, UINT, UINT2, OBJECT, UINT_TYPECODE, \
+    FmpBuffer, FmpWriter, uint_view
+from lib.fmp_container import ENCODING_RAW, ENCODINGS, Container, Section, \
+    compress, decompress, is_container, write_container
+from lib.tilesets import load_tilesets, find_tileset, tileset_index
+from collections import namedtuple, OrderedDict
 from math import floor
+from array import array
+from itertools import groupby
+from operator import mul
 import gzip
 
 
@@ -32,13 +42,13 @@ def represents_bool(s):
 
 
 def read_typed_value(fh):
-    ty = unpack("b", fh.read(1))[0]
+    ty = fh.read_byte()
     if ty == 0:
-        val = unpack("I", fh.read(4))[0]
+        val = fh.read_uint()
     elif ty == 1:
-        val = unpack("b", fh.read(1))[0] == 1
+        val = fh.read_byte() == 1
     elif ty == 2:
-        val = read_string(fh)
+        val = fh.read_string()
     else:
         raise Exception("unknown typed value " + str(ty))
     return val
@@ -46,51 +56,423 @@ def read_typed_value(fh):
 
 def write_typed_value(out, prop, prop_type):
     if prop_type == "int":
-        out.write(pack("b", 0))
-        out.write(pack("I", int(prop)))
+        out.pack(BYTE, 0)
+        out.pack(UINT, int(prop))
     elif prop_type == "bool":
-        out.write(pack("b", 1))
-        out.write(pack("b", bool(prop)))
+        out.pack(BYTE, 1)
+        out.pack(BYTE, bool(prop))
     else:
-        out.write(pack("b", 2))
-        write_string(out, prop)
+        out.pack(BYTE, 2)
+        out.write_string(prop)
 
 
-def read_string(fh):
-    return "".join(iter(lambda: fh.read(1).decode("ascii"), "\x00"))
+FmpHeader = namedtuple(
+    "FmpHeader", "version mods ids_to_names mdata width height tiles_offset")
 
 
-def write_string(out, s):
-    out.write(str.encode(s))
-    out.write(b"\0")
+def read_header(fh, version=None):
+    """
+    Reads everything in front of the tile grid. fh must be positioned
+    just after the "FMP " magic, or at the start of the HEAD section of
+    a container, whose version is passed in.
+    """
+    if version == None:
+        version = fh.read_uint()
 
+    mod_count = fh.read_uint()
+    mods = set()
+    for i in range(mod_count):
+        mods.add(fh.read_string())
 
-def load_tileset(m, filename):
-    print("load " + filename)
-    if not exists(filename):
-        raise Exception("cannot find tileset file " + filename)
-    tileset = T.loadTileset(filename)
-    if tileset == None:
-        raise Exception("failed to load " + filename)
-    m.addTileset(tileset)
+    ids_to_names = read_dict(fh)
+
+    mdata = read_properties(fh, ids_to_names)
+
+    width, height = fh.unpack(UINT2)
+
+    return FmpHeader(version, mods, ids_to_names, mdata, width, height, fh.pos)
+
+
+def read_fmp_header(f):
+    """
+    Returns the FmpHeader of an .fmp file, or None if f is not one. Only
+    the start of the file is inflated.
+    """
+    if is_container(f):
+        try:
+            return read_container_header(Container(f))
+        except Exception:
+            return None
+
+    size = 4096
+    while True:
+        head = probe.read_head(f, size)
+        if head == None or head[:4] != b"FMP ":
+            return None
+        try:
+            return read_header(FmpBuffer(head, 4))
+        except Exception:
+            # Either the header is larger than what was inflated, or
+            # the file is broken.
+            if len(head) < size:
+                return None
+            size *= 4
+
+
+def read_container_header(container):
+    return read_header(FmpBuffer(bytes(container.data(b"HEAD"))),
+                       container.version)
+
+
+probe_fmp = probe.memoized(read_fmp_header)
 
 
-def load_tilesets(m, atlas, directory):
-    tileset_directory = join(directory, "Elona_foobar")
+class FmpFile():
+    """
+    An .fmp file decoded on demand. The header fields are read the first
+    time one of them is used, inflating only the start of the file. The
+    tile grid and the layers are decoded the first time each of them is
+    used. Once both are, the tile grid is copied out of the inflated
+    file and the file is dropped.
 
-    tile_atlas = join(tileset_directory, "map%01i.tsx" % atlas)
-    load_tileset(m, tile_atlas)
+    Version 2 files are containers and are mapped instead of inflated.
+    Their tile grid is used in place unless it was stored compressed.
+    """
 
-    for filename in os.listdir(tileset_directory):
-        if filename == "map0.tsx" or filename == "map1.tsx" or filename == "map2.tsx":
-            continue
-        if filename.endswith(".tsx"):
-            print("load " + filename)
-            atlas = join(tileset_directory, filename)
-            load_tileset(m, atlas)
+    def __init__(self, f):
+        self.f = f
+        self.fh = None
+        self.container = None
+        self._header = None
+        self._tiles = None
+        self._layers = None
+
+    def load(self):
+        """Reads the whole file up front, for when all of it is needed."""
+        if self.fh == None and self.container == None:
+            if is_container(self.f):
+                self.container = Container(self.f)
+            else:
+                self.fh = FmpBuffer.open(self.f)
+                if self.fh.buf[:4] != b"FMP ":
+                    raise Exception("not an .fmp file: " + str(self.f))
+
+    @property
+    def header(self):
+        if self._header == None:
+            if self.container != None:
+                self._header = read_container_header(self.container)
+            elif self.fh != None:
+                self.fh.pos = 4
+                self._header = read_header(self.fh)
+            else:
+                self._header = read_fmp_header(self.f)
+                if self._header == None:
+                    raise Exception("not an .fmp file: " + str(self.f))
+        return self._header
+
+    @property
+    def version(self):
+        return self.header.version
+
+    @property
+    def mods(self):
+        return self.header.mods
+
+    @property
+    def ids_to_names(self):
+        return self.header.ids_to_names
+
+    @property
+    def mdata(self):
+        return self.header.mdata
+
+    @property
+    def width(self):
+        return self.header.width
+
+    @property
+    def height(self):
+        return self.header.height
+
+    @property
+    def tiles(self):
+        if self._tiles == None:
+            header = self.header
+            self.load()
+            if self.container != None and b"TCHI" in self.container.sections:
+                self._tiles = ChunkedTileGrid(
+                    header.width, header.height,
+                    self.container.section(b"TCHI"),
+                    self.container.section(b"TCHD"), header.ids_to_names)
+            elif self.container != None and b"TPAL" in self.container.sections:
+                self._tiles = read_tile_runs(
+                    FmpBuffer(bytes(self.container.data(b"TPAL"))),
+                    header.width, header.height, header.ids_to_names)
+            elif self.container != None:
+                ids = uint_view(self.container.data(b"TILE"), 0,
+                                header.width * header.height)
+                self._tiles = TileGrid(
+                    header.width, header.height, ids, header.ids_to_names)
+            else:
+                self.fh.pos = header.tiles_offset
+                self._tiles = read_tiles(
+                    self.fh, header.width, header.height, header.ids_to_names)
+            self.release()
+        return self._tiles
+
+    @property
+    def layers(self):
+        if self._layers == None:
+            layers = list()
+            for layer in self.iter_layers():
+                layer["objs"] = list(layer["objs"])
+                layers.append(layer)
+            self._layers = layers
+            self.release()
+        return self._layers
+
+    def iter_layers(self):
+        """
+        Yields the layers one at a time as they are decoded, without
+        keeping them. See iter_layers.
+        """
+        if self._layers != None:
+            return iter(self._layers)
+        header = self.header
+        self.load()
+        if self.container != None:
+            fh = FmpBuffer(bytes(self.container.data(b"LAYR")))
+        else:
+            # A cursor of its own, so that the tiles can be read while
+            # the layers are being streamed.
+            fh = FmpBuffer(self.fh.buf, header.tiles_offset +
+                           header.width * header.height * UINT.size)
+        return iter_layers(fh, header.ids_to_names)
+
+    def release(self):
+        # The inflated file is only needed until both parts are decoded,
+        # except for a version 1 tile grid, which is a view into it: copy
+        # the grid out so the rest of the buffer can be freed. A mapped
+        # file stays open for as long as its tile grid is used.
+        if self._tiles != None and self._layers != None and self.fh != None:
+            if isinstance(self._tiles.ids, memoryview):
+                ids = array(UINT_TYPECODE)
+                ids.frombytes(self._tiles.ids.cast("B"))
+                self._tiles.ids = ids
+            self.fh = None
+
+
+class TileGrid():
+    """
+    Map tiles stored as one uint32 id per cell, next to the id -> data_id
+    table used to name them. Decoded grids are a view into the file's
+    buffer, or into the mapped file for containers, rather than a copy
+    (see FmpFile.release).
+    """
+
+    def __init__(self, width, height, ids, ids_to_names):
+        assert(len(ids) == width * height)
+        self.width = width
+        self.height = height
+        self.ids = ids
+        self.ids_to_names = ids_to_names
+
+    @classmethod
+    def filled(cls, width, height, data_id):
+        ids = array(UINT_TYPECODE, [0]) * (width * height)
+        return TileGrid(width, height, ids, {0: data_id})
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, pos):
+        x, y = pos
+        return self.ids_to_names[self.ids[y * self.width + x]]
+
+    def name(self, tile_id):
+        return self.ids_to_names[tile_id]
+
+    def row(self, y):
+        return self.ids[y * self.width:(y + 1) * self.width]
+
+    def unique_ids(self):
+        return set(self.ids)
+
+    def bands(self):
+        """Yields (y, TileGrid) for bands of rows; here, the whole grid."""
+        yield 0, self
+
+    def region(self, x, y, width, height):
+        """Returns the cells of a viewport, clipped to the map, as a TileGrid."""
+        x0, y0, x1, y1 = clip_region(self, x, y, width, height)
+        ids = array(getattr(self.ids, "typecode", UINT_TYPECODE))
+        for row_y in range(y0, y1):
+            ids.extend(self.ids[row_y * self.width + x0:row_y * self.width + x1])
+        return TileGrid(x1 - x0, y1 - y0, ids, self.ids_to_names)
+
+
+def clip_region(grid, x, y, width, height):
+    x0 = min(max(x, 0), grid.width)
+    y0 = min(max(y, 0), grid.height)
+    x1 = min(max(x + width, x0), grid.width)
+    y1 = min(max(y + height, y0), grid.height)
+    return x0, y0, x1, y1
+
+
+class ChunkedTileGrid():
+    """
+    Tile grid stored as separately compressed chunks, listed in a chunk
+    index. Chunks are decoded when a cell in them is first used and only
+    the CHUNK_CACHE_SIZE most recently used ones are kept, or one row of
+    chunks if that is more, so reading a viewport costs the same however
+    large the map is.
+    """
+
+    CHUNK_CACHE_SIZE = 64
+
+    def __init__(self, width, height, index, data, ids_to_names):
+        fh = FmpBuffer(bytes(index))
+        self.width = width
+        self.height = height
+        self.chunk_width, self.chunk_height = fh.unpack(UINT2)
+        self.encoding = fh.read_uint()
+        self.columns = -(-width // self.chunk_width)
+        self.rows = -(-height // self.chunk_height)
+        # offset, length of each chunk in data, in row order
+        self.extents = fh.read_uints(2 * self.columns * self.rows)
+        self.data = data
+        self.ids_to_names = ids_to_names
+        self.chunks = OrderedDict()
+
+    def chunk_size(self, cx, cy):
+        return min(self.chunk_width, self.width - cx * self.chunk_width), \
+            min(self.chunk_height, self.height - cy * self.chunk_height)
+
+    def decode_chunk(self, cx, cy):
+        i = cy * self.columns + cx
+        offset, length = self.extents[2 * i], self.extents[2 * i + 1]
+        width, height = self.chunk_size(cx, cy)
+        raw = decompress(self.encoding, self.data[offset:offset + length],
+                         width * height * UINT.size)
+        return memoryview(uint_view(raw, 0, width * height))
+
+    def chunk(self, cx, cy):
+        ids = self.chunks.get((cx, cy))
+        if ids == None:
+            ids = self.decode_chunk(cx, cy)
+            self.chunks[(cx, cy)] = ids
+            if len(self.chunks) > max(ChunkedTileGrid.CHUNK_CACHE_SIZE,
+                                      self.columns):
+                self.chunks.popitem(last=False)
+        else:
+            self.chunks.move_to_end((cx, cy))
+        return ids
+
+    def __len__(self):
+        return self.width * self.height
+
+    def __getitem__(self, pos):
+        x, y = pos
+        cx, cy = x // self.chunk_width, y // self.chunk_height
+        width, height = self.chunk_size(cx, cy)
+        ids = self.chunk(cx, cy)
+        return self.ids_to_names[ids[(y % self.chunk_height) * width +
+                                     x % self.chunk_width]]
+
+    def name(self, tile_id):
+        return self.ids_to_names[tile_id]
+
+    def copy_rows(self, ids, chunks, x0, y0, x1, y1):
+        for y in range(y0, y1):
+            cy = y // self.chunk_height
+            for cx in range(x0 // self.chunk_width,
+                            (x1 - 1) // self.chunk_width + 1):
+                width, height = self.chunk_size(cx, cy)
+                left = cx * self.chunk_width
+                start = (y - cy * self.chunk_height) * width
+                chunk = chunks(cx, cy)
+                ids.frombytes(chunk[start + max(x0 - left, 0):
+                                    start + min(x1 - left, width)].cast("B"))
+
+    def row(self, y):
+        ids = array(UINT_TYPECODE)
+        self.copy_rows(ids, self.chunk, 0, y, self.width, y + 1)
+        return ids
+
+    def unique_ids(self):
+        # Chunks are decoded one at a time and not kept.
+        ids = set()
+        for cy in range(self.rows):
+            for cx in range(self.columns):
+                ids.update(self.decode_chunk(cx, cy))
+        return ids
+
+    def bands(self):
+        """
+        Yields (y, TileGrid) for each row of chunks, for reading the whole
+        grid. Every chunk is decoded once and not kept.
+        """
+        for cy in range(self.rows):
+            y0 = cy * self.chunk_height
+            width, height = self.chunk_size(0, cy)
+            chunks = [self.decode_chunk(cx, cy) for cx in range(self.columns)]
+            ids = array(UINT_TYPECODE)
+            self.copy_rows(ids, lambda cx, cy: chunks[cx],
+                           0, y0, self.width, y0 + height)
+            yield y0, TileGrid(self.width, height, ids, self.ids_to_names)
+
+    def region(self, x, y, width, height):
+        """
+        Returns the cells of a viewport, clipped to the map, as a
+        TileGrid. Only the chunks it intersects are decoded.
+        """
+        x0, y0, x1, y1 = clip_region(self, x, y, width, height)
+        ids = array(UINT_TYPECODE)
+        if x1 > x0 and y1 > y0:
+            chunks = dict()
+
+            def region_chunk(cx, cy):
+                if not (cx, cy) in chunks:
+                    chunks[(cx, cy)] = self.chunk(cx, cy)
+                return chunks[(cx, cy)]
+
+            self.copy_rows(ids, region_chunk, x0, y0, x1, y1)
+        return TileGrid(x1 - x0, y1 - y0, ids, self.ids_to_names)
+
+
+TILE_ENCODINGS = ("raw", "palette", "chunked")
+
+# Width and height of the chunks of a "chunked" tile grid.
+TILE_CHUNK_SIZE = 32
 
 
 class ElonaFoobar(T.Plugin):
+    # Load only the map's atlas up front, and the tilesets of its objects
+    # as they are read. Fine for batch conversion, but in the editor every
+    # tileset has to be loaded to be able to place new objects.
+    lazy_tilesets = False
+
+    # .fmp version written by default. Version 1 is a single gzip
+    # stream; version 2 is an uncompressed container whose tile grid
+    # can be mapped and read in place (see lib/fmp_container.py).
+    write_version = 1
+
+    # Compression of the files written. Version 1 is always "gzip";
+    # version 2 can use "none", "zlib" or "lzma", recorded per section.
+    # A level of None is the codec's default, FAST_LEVEL trades size for
+    # speed, e.g. for interactive saves.
+    write_compression = None
+    write_level = None
+    FAST_LEVEL = 1
+
+    # How version 2 stores the tile grid: "raw" uint32 ids, which can be
+    # read in place, a "palette" of the ids used and runs of cells, when
+    # that is smaller than raw ids, or "chunked" into separately
+    # compressed TILE_CHUNK_SIZE squares that are decoded as they are
+    # used.
+    write_tile_encoding = "raw"
+
     @classmethod
     def shortName(cls):
         return "fmp"
@@ -101,29 +483,36 @@ class ElonaFoobar(T.Plugin):
 
     @classmethod
     def supportsFile(cls, f):
-        with gzip.open(f, "rb") as fh:
-            return fh.read(4) == b"FMP "
+        return probe_fmp(f) != None
 
     @classmethod
-    def init_map(cls, foo, m):
+    def init_map(cls, foo, m, indexes=None):
         for k, v in foo.mdata.items():
             m.setProperty(k, v)
 
+        # With lazy_tilesets, the tilesets the map's objects use are
+        # loaded by find_tileset as the objects are read.
+        data_types = None
+        if ElonaFoobar.lazy_tilesets:
+            data_types = set()
+
         base_directory = dirname(realpath(__file__))
-        load_tilesets(m, foo.mdata["atlas"], base_directory)
+        load_tilesets(m, foo.mdata["atlas"], base_directory, data_types)
 
         tile_layer = T.Tiled.TileLayer(
             "Tiles", 0, 0, foo.width, foo.height)
 
-        load_tiles(m, tile_layer, foo.tiles)
+        if indexes == None:
+            indexes = dict()
+        load_tiles(m, tile_layer, foo.tiles, indexes)
         m.addLayer(tile_layer)
 
-        for layer in foo.layers:
+        for layer in foo.iter_layers():
             if layer["kind"] == 0:  # tile layer
                 pass
             elif layer["kind"] == 1:  # object group
                 new_layer = T.Tiled.ObjectGroup(layer["name"], 0, 0)
-                load_objects(m, new_layer, layer["objs"])
+                load_objects(m, new_layer, layer["objs"], indexes)
                 m.addLayer(new_layer)
             elif layer["kind"] == 2:  # group layer
                 new_layer = T.Tiled.GroupLayer(layer["name"], 0, 0)
@@ -132,7 +521,7 @@ class ElonaFoobar(T.Plugin):
                 pass
 
     @classmethod
-    def read(cls, f):
+    def read(cls, f, indexes=None):
         # Read map binary data.
         foo = ElonaFoobar(f)
 
@@ -140,7 +529,7 @@ class ElonaFoobar(T.Plugin):
         m = T.Tiled.Map(T.Tiled.Map.Orthogonal, foo.width, foo.height, 48, 48)
 
         # Load layers and properties into Tiled.
-        ElonaFoobar.init_map(foo, m)
+        ElonaFoobar.init_map(foo, m, indexes)
 
         return m
 
@@ -155,103 +544,77 @@ class ElonaFoobar(T.Plugin):
             self.width = self.mdata["width"]
             self.height = self.mdata["height"]
 
-            self.tiles = [
-                "core." + str(self.mdata["atlas"]) + "_0"] * self.width * self.height
+            self.tiles = TileGrid.filled(
+                self.width, self.height, "core." + str(self.mdata["atlas"]) + "_0")
 
-            self.layers = list()
+            self.fmp = None
+            self._layers = list()
 
             return
 
-        self.mdata = dict()
-        with gzip.open(f, "rb") as fh:
-            fh.read(4)
-
-            self.version = unpack("I", fh.read(4))[0]
-            print("version " + str(self.version))
-
-            mod_count = unpack("I", fh.read(4))[0]
-            print("mod count " + str(mod_count))
-            self.mods = set()
-            for i in range(mod_count):
-                self.mods.add(read_string(fh))
-
-            ids_to_names = read_dict(fh)
-
-            self.mdata = read_properties(fh, ids_to_names)
+        fmp = FmpFile(f)
+        fmp.load()
 
-            self.width, self.height = unpack("II", fh.read(2 * 4))
+        self.version = fmp.version
+        print("version " + str(self.version))
+        print("mod count " + str(len(fmp.mods)))
+        self.mods = fmp.mods
+        self.mdata = fmp.mdata
+        self.width = fmp.width
+        self.height = fmp.height
 
-            self.tiles = read_tiles(fh, self.width, self.height, ids_to_names)
+        self.tiles = fmp.tiles
 
-            self.layers = list()
-            layer_count = unpack("I", fh.read(4))[0]
-            print("LAYER COUNT {}".format(layer_count))
+        # Layers are decoded as they are iterated.
+        self.fmp = fmp
+        self._layers = None
 
-            for i in range(layer_count):
-                self.layers.append(read_layer(fh, ids_to_names))
+    @property
+    def layers(self):
+        """All the layers, decoded at once. See iter_layers."""
+        if self._layers == None:
+            self._layers = self.fmp.layers
+        return self._layers
 
-    @classmethod
-    def tile_layer_is_used(cls, tiles):
-        for y in range(tiles.height()):
-            for x in range(tiles.width()):
-                tile = tiles.cellAt(x, y).tile()
-                if tile != None:
-                    return True
-        return False
+    def iter_layers(self):
+        if self._layers != None:
+            return iter(self._layers)
+        return self.fmp.iter_layers()
 
     @classmethod
     def validate(cls, m):
-        map_atlas = m.propertyAsString("atlas")
-
-        tile_layer_count = 0
-        for i in range(m.layerCount()):
-            l = m.layerAt(i)
-
-            if l.isTileLayer():
-                tiles = l.asTileLayer()
-                if ElonaFoobar.tile_layer_is_used(tiles):
-                    tile_layer_count += 1
-
-        if tile_layer_count != 1:
-            raise Exception(
-                "There must be exactly 1 non-empty tile layer used, but there were '{}' found.".format(tile_layer_count))
-
-        for i in range(m.layerCount()):
-            l = m.layerAt(i)
-
-            if l.isTileLayer():
-                tiles = l.asTileLayer()
-                for y in range(tiles.height()):
-                    for x in range(tiles.width()):
-                        tile = tiles.cellAt(x, y).tile()
-
-                        if tile == None:
-                            continue
-                        if tile.type() != "core.map_chip":
-                            raise Exception(
-                                "The tile at ({},{}) does not come from the core.map_chip atlas, but is from '{}'. (Did you insert a character/item tile by accident?".format(x / 48, y / 48, tile.type()))
-                        tile_atlas = tile.propertyAsString("atlas")
-                        if tile_atlas != map_atlas:
-                            raise Exception(
-                                "The tile at ({},{}) is from atlas '{}', but this map's atlas is '{}'.".format(
-                                    x / 48, y / 48, tile_atlas, map_atlas))
-            elif l.isObjectGroup():
-                objs = l.asObjectGroup()
-
-                for i in range(objs.objectCount()):
-                    obj = objs.objectAt(i)
-
-                    if obj.effectiveType() == "core.map_chip":
-                        raise Exception(
-                            "The object at ({},{}) is of type core.map_chip. (Did you insert a map tile as an object by accident?".format(obj.x() / 48, obj.y() / 48))
+        analyze_map(m)
         return True
 
     @classmethod
-    def write(cls, m, filename):
+    def write(cls, m, filename, indexes=None, version=None, compression=None,
+              level=None, tile_encoding=None):
         m.setInfinite(False)
         m.setOrientation(T.Tiled.Map.Orthogonal)
         m.setRenderOrder(T.Tiled.Map.RightDown)
 
+        if version == None:
+            version = ElonaFoobar.write_version
+        if not version in (1, 2):
+            raise Exception("unknown .fmp version " + str(version))
+        if compression == None:
+            compression = ElonaFoobar.write_compression
+        if compression == None:
+            compression = "gzip" if version == 1 else "none"
+        if level == None:
+            level = ElonaFoobar.write_level
+        if version == 1 and compression != "gzip":
+            raise Exception(
+                ".fmp version 1 only supports gzip, not " + compression)
+        if version != 1 and not compression in ENCODINGS:
+            raise Exception("unknown .fmp compression " + compression)
+        if tile_encoding == None:
+            tile_encoding = ElonaFoobar.write_tile_encoding
+        if not tile_encoding in TILE_ENCODINGS:
+            raise Exception("unknown tile encoding " + tile_encoding)
+        if version == 1 and tile_encoding != "raw":
+            raise Exception(".fmp version 1 only stores raw tiles")
+
         is_new_map = m.tilesetCount() == 0
         if is_new_map:
             print("NEW MAP")
@@ -268,83 +631,90 @@ class ElonaFoobar(T.Plugin):
                 "max_crowd_density": m.width() * m.height() / 100
             }
             foo = ElonaFoobar(mdata)
-            ElonaFoobar.init_map(foo, m)
-
-        if not ElonaFoobar.validate(m):
-            return False
-
-        with gzip.open(splitext(filename)[0] + ".fmp", "wb") as out:
-            out.write(pack("4s", b"FMP "))
-
-            # Map version.
-            version = 1
-            out.write(pack("I", version))
-
-            # Mod name/version.
-            mods = collect_mods_used(m)
-            out.write(pack("I", len(mods)))
-            for mod in mods:
-                write_string(out, mod)
-
-            # Int -> String.
-            property_names = collect_property_names(m)
-            write_dict(out, property_names)
+            ElonaFoobar.init_map(foo, m, indexes)
+
+        # Raises if the map cannot be saved.
+        analysis = analyze_map(m, indexes)
+
+        filename = splitext(filename)[0] + ".fmp"
+        if version == 1:
+            out = FmpWriter()
+            out.write_bytes(b"FMP ")
+            out.pack(UINT, version)
+            write_header(out, m, analysis)
+            write_tiles(out, analysis)
+            write_layers(out, m, analysis)
+
+            with gzip.open(filename, "wb",
+                           compresslevel=9 if level == None else level) as fh:
+                fh.write(out.getbuffer())
+        else:
+            encoding = ENCODINGS[compression]
+            head = FmpWriter()
+            write_header(head, m, analysis)
+            sections = [
+                Section.encode(b"HEAD", encoding, head.getbuffer(), level)]
+
+            if tile_encoding == "chunked":
+                # The chunks are compressed one by one, so that they can
+                # be read from the mapped file one by one.
+                index = FmpWriter()
+                data = FmpWriter()
+                write_tile_chunks(index, data, analysis, m.width(),
+                                  m.height(), encoding, level)
+                sections.append(
+                    Section(b"TCHI", ENCODING_RAW, index.getbuffer()))
+                sections.append(
+                    Section(b"TCHD", ENCODING_RAW, data.getbuffer()))
+            else:
+                tiles = FmpWriter(len(analysis.tile_ids) * UINT.size)
+                write_tiles(tiles, analysis)
+                section = Section.encode(
+                    b"TILE", encoding, tiles.getbuffer(), level)
+                if tile_encoding == "palette":
+                    # Noisy grids can come out larger as a palette; those
+                    # are kept as plain ids.
+                    tiles = FmpWriter()
+                    write_tile_runs(tiles, analysis)
+                    palette = Section.encode(
+                        b"TPAL", encoding, tiles.getbuffer(), level)
+                    if len(palette.data) < len(section.data):
+                        section = palette
+                sections.append(section)
+
+            layers = FmpWriter()
+            write_layers(layers, m, analysis)
+            sections.append(
+                Section.encode(b"LAYR", encoding, layers.getbuffer(), level))
+
+            write_container(filename, version, sections)
 
-            write_properties(out, m, property_names)
+        return True
 
-            out.write(pack("II", m.width(), m.height()))
 
-            write_tiles(out, m, property_names)
+def write_header(out, m, analysis):
+    # Mod name/version.
+    mods = analysis.mods
+    out.pack(UINT, len(mods))
+    for mod in mods:
+        out.write_string(mod)
 
-            out.write(pack("I", m.layerCount()))
+    # Int -> String.
+    property_names = analysis.mapping.names_to_ids
+    write_dict(out, property_names)
 
-            print("LAYER COUNT WRITE {}".format(m.layerCount()))
-            for i in range(m.layerCount()):
-                l = m.layerAt(i)
-                write_layer(out, m, l, i, property_names)
+    write_properties(out, m, property_names)
 
-        return True
+    out.pack(UINT2, m.width(), m.height())
 
 
-def collect_mods_used(m):
-    mods = set()
+def write_layers(out, m, analysis):
+    out.pack(UINT, m.layerCount())
 
+    print("LAYER COUNT WRITE {}".format(m.layerCount()))
     for i in range(m.layerCount()):
         l = m.layerAt(i)
-
-        # tiles
-        if l.isTileLayer():
-            mdata = l.asTileLayer()
-            print("tile layer " + l.name() + " " + str(mdata.isEmpty()))
-            print(str(mdata.width()) + " " + str(mdata.height()))
-            for y in range(mdata.height()):
-                for x in range(mdata.width()):
-                    tile = mdata.cellAt(x, y).tile()
-                    if tile == None:
-                        continue
-
-                    data_id = tile.propertyAsString("data_id")
-                    mod, name = data_id.split(".")
-                    if not mod in mods:
-                        mods.add(mod)
-
-        # objects
-        elif l.isObjectGroup():
-            objs = l.asObjectGroup()
-            for i in range(objs.objectCount()):
-                o = objs.objectAt(i)
-
-                data_id = o.effectiveType()
-                mod, name = data_id.split(".")
-                if not mod in mods:
-                    mods.add(mod)
-
-                data_id = o.cell().tile().propertyAsString("data_id")
-                mod, name = data_id.split(".")
-                if not mod in mods:
-                    mods.add(mod)
-
-    return mods
+        write_layer(out, m, l, i, analysis.mapping.names_to_ids)
 
 
 class Mapping():
@@ -358,141 +728,307 @@ class Mapping():
             self.i += 1
 
 
-def collect_property_names(m):
-    print("collect property names")
-    mapping = Mapping()
-    default_tile = get_default_tile(m)
+def add_mod(mods, data_id):
+    mod, name = data_id.split(".")
+    mods.add(mod)
+
+
+class MapAnalysis():
+    """
+    Everything ElonaFoobar.write needs to know about a map, gathered by
+    analyze_map in a single pass over its cells and objects.
+    """
+
+    def __init__(self):
+        self.mods = set()
+        self.mapping = Mapping()
+        self.tile_ids = None
+        self.tile_layer_count = 0
+        self.error = None
+
+    def fail(self, message):
+        # Keep the first problem found; it is raised once the pass is done.
+        if self.error == None:
+            self.error = message
+
+
+def analyze_tile(result, tile, x, y, map_atlas):
+    if tile.type() != "core.map_chip":
+        result.fail(
+            "The tile at ({},{}) does not come from the core.map_chip atlas, but is from '{}'. (Did you insert a character/item tile by accident?".format(x / 48, y / 48, tile.type()))
+    tile_atlas = tile.propertyAsString("atlas")
+    if tile_atlas != map_atlas:
+        result.fail(
+            "The tile at ({},{}) is from atlas '{}', but this map's atlas is '{}'.".format(
+                x / 48, y / 48, tile_atlas, map_atlas))
+
+    data_id = tile.propertyAsString("data_id")
+    add_mod(result.mods, data_id)
+    result.mapping.add(data_id)
+    for key in tile.properties().keys():
+        result.mapping.add(key)
+    return result.mapping.names_to_ids[data_id]
+
+
+def analyze_object(result, o):
+    data_type = o.effectiveType()
+    if data_type == "core.map_chip":
+        result.fail(
+            "The object at ({},{}) is of type core.map_chip. (Did you insert a map tile as an object by accident?".format(o.x() / 48, o.y() / 48))
+
+    tile = o.cell().tile()
+    data_id = tile.propertyAsString("data_id")
+    add_mod(result.mods, data_type)
+    add_mod(result.mods, data_id)
+
+    mapping = result.mapping
+    mapping.add(o.name())
+    mapping.add(data_type)
+    for key in o.properties().keys():
+        mapping.add(key)
+    mapping.add(data_id)
+    for key in tile.properties().keys():
+        mapping.add(key)
+
+
+def analyze_map(m, indexes=None):
+    """
+    Validates the map and collects the mods used, the name -> id mapping
+    and the tile ids of the first tile layer, visiting each cell and
+    object once. Raises if the map cannot be saved.
+    """
+    result = MapAnalysis()
+    mapping = result.mapping
+    map_atlas = m.propertyAsString("atlas")
+    get_default_tile(m, indexes)
 
-    # map
     for key in m.properties().keys():
         mapping.add(key)
 
-    # layers
+    # Tiles are resolved the first time they are seen. The tileset's
+    # type and atlas are part of the key since tile ids are only unique
+    # within a tileset.
+    resolved = dict()
+    empty_cells = list()
+
     for i in range(m.layerCount()):
         l = m.layerAt(i)
 
-        # tiles
         if l.isTileLayer():
-            mdata = l.asTileLayer()
-            print(str(mdata.width()) + " " + str(mdata.height()))
-            for y in range(mdata.height()):
-                for x in range(mdata.width()):
-                    # tile property names
-                    cell = mdata.cellAt(x, y)
-                    tile = cell.tile()
+            tiles = l.asTileLayer()
+            width = tiles.width()
+
+            # Only the first tile layer found is written.
+            ids = None
+            if result.tile_ids == None:
+                ids = array(UINT_TYPECODE, [0]) * (width * tiles.height())
+                result.tile_ids = ids
+
+            used = False
+            for y in range(tiles.height()):
+                for x in range(width):
+                    tile = tiles.cellAt(x, y).tile()
                     if tile == None:
+                        if ids != None:
+                            empty_cells.append(y * width + x)
                         continue
-                    mapping.add(tile.propertyAsString("data_id"))
-                    for key in tile.properties().keys():
-                        mapping.add(key)
-
-        # objects
-        elif l.isObjectGroup():
-            objs = l.asObjectGroup()
-            for i in range(objs.objectCount()):
-                o = objs.objectAt(i)
-
-                mapping.add(o.name())
-                mapping.add(o.effectiveType())
 
-                for key in o.properties().keys():
-                    mapping.add(key)
+                    used = True
+                    key = (tile.type(), tile.id(),
+                           tile.propertyAsString("atlas"))
+                    tile_id = resolved.get(key)
+                    if tile_id == None:
+                        tile_id = analyze_tile(result, tile, x, y, map_atlas)
+                        resolved[key] = tile_id
+                    if ids != None:
+                        ids[y * width + x] = tile_id
 
-                mapping.add(o.cell().tile().propertyAsString("data_id"))
+            if used:
+                result.tile_layer_count += 1
 
-                for key in o.cell().tile().properties().keys():
-                    mapping.add(key)
+        elif l.isObjectGroup():
+            objs = l.asObjectGroup()
+            for j in range(objs.objectCount()):
+                analyze_object(result, objs.objectAt(j))
 
         for key in l.properties().keys():
             mapping.add(key)
 
-    pprint(mapping.names_to_ids)
-    return mapping.names_to_ids
+    if result.tile_layer_count != 1:
+        raise Exception(
+            "There must be exactly 1 non-empty tile layer used, but there were '{}' found.".format(result.tile_layer_count))
+    if result.error != None:
+        raise Exception(result.error)
+
+    # Empty cells are saved as the atlas' default tile.
+    if len(empty_cells) > 0:
+        default_id = "core." + map_atlas + "_0"
+        mapping.add(default_id)
+        tile_id = mapping.names_to_ids[default_id]
+        for i in empty_cells:
+            result.tile_ids[i] = tile_id
+
+    return result
 
 
 def read_dict(fh):
     ids_to_names = dict()
-    key_count = unpack("I", fh.read(4))[0]
-    print("dict " + str(key_count))
+    key_count = fh.read_uint()
     for i in range(key_count):
-        key = read_string(fh)
-        value = unpack("I", fh.read(4))[0]
+        key = fh.read_string()
+        value = fh.read_uint()
         ids_to_names[value] = key
 
-    pprint(ids_to_names)
     return ids_to_names
 
 
 def write_dict(out, d):
     print("WRITE dict")
     pprint(d)
-    out.write(pack("I", len(d.keys())))
+    out.pack(UINT, len(d.keys()))
     for key in d.keys():
-        write_string(out, key)
+        out.write_string(key)
         assert(isinstance(d[key], int))
-        out.write(pack("I", d[key]))
+        out.pack(UINT, d[key])
 
 
 def read_properties(fh, ids_to_names):
-    print("props")
     props = dict()
-    key_count = unpack("I", fh.read(4))[0]
+    key_count = fh.read_uint()
 
     for i in range(key_count):
-        key_id = unpack("I", fh.read(4))[0]
+        key_id = fh.read_uint()
         key = ids_to_names[key_id]
         val = read_typed_value(fh)
         props[key] = val
 
-    pprint(props)
     return props
 
 
 def write_properties(out, m, names_to_ids):
-    out.write(pack("I", len(list(m.properties().keys()))))
+    out.pack(UINT, len(list(m.properties().keys())))
     for key in m.properties().keys():
-        out.write(pack("I", names_to_ids[key]))
+        out.pack(UINT, names_to_ids[key])
 
         prop = m.propertyAsString(key)
         prop_type = m.propertyType(key)
         write_typed_value(out, prop, prop_type)
 
 
-def get_default_tile(m):
+def get_default_tile(m, indexes=None):
     default_id = "core." + m.propertyAsString("atlas") + "_0"
     default_tile = find_map_tile_across_all_tilesets(
-        m, default_id)
+        m, default_id, indexes)
     if default_tile == None:
         raise Exception("Could not find default tile '{}'".format(default_id))
     return default_tile
 
 
 def read_tiles(fh, width, height, ids_to_names):
-    raw_tiles = list(
-        unpack("I" * (width * height), fh.read(width * height * 4)))
-    return list(map(lambda tile_id: ids_to_names[tile_id], raw_tiles))
+    ids = fh.read_uints(width * height)
+    return TileGrid(width, height, ids, ids_to_names)
 
 
-def write_tiles(out, m, names_to_ids):
-    for i in range(m.layerCount()):
-        if T.isTileLayerAt(m, i):
-            mdata = T.tileLayerAt(m, i)
+def write_tiles(out, analysis):
+    out.write_uints(analysis.tile_ids)
 
-            for y in range(mdata.height()):
-                for x in range(mdata.width()):
-                    cell = mdata.cellAt(x, y)
-                    tile = cell.tile()
-                    if tile == None:
-                        data_id = "core." + m.propertyAsString("atlas") + "_0"
-                    else:
-                        data_id = tile.propertyAsString("data_id")
-                    out.write(pack("I", names_to_ids[data_id]))
 
-            # Only write the first tile layer found. The format
-            # assumes that only (width * height) tiles are written,
-            # and having more than one layer will cause an error on
-            # load.
-            break
+def palette_typecode(palette_count):
+    if palette_count <= 0x100:
+        return "B"
+    elif palette_count <= 0x10000:
+        return "H"
+    return UINT_TYPECODE
+
+
+def read_tile_runs(fh, width, height, ids_to_names):
+    """
+    Reads a tile grid stored as a palette of dictionary ids followed by
+    either runs of cells or, with a run count of 0, one palette index per
+    cell. The grid holds the palette indexes, usually one byte each, and
+    names them through the palette.
+    """
+    palette_count, run_count = fh.unpack(UINT2)
+    palette = fh.read_uints(palette_count)
+    typecode = palette_typecode(palette_count)
+
+    if run_count == 0:
+        ids = fh.read_array(typecode, width * height)
+    else:
+        lengths = fh.read_uints(run_count)
+        indexes = fh.read_array(typecode, run_count)
+        # The runs are repeated and joined as bytes by map and join,
+        # without running Python code for each run.
+        units = [array(typecode, [i]).tobytes() for i in range(palette_count)]
+        ids = array(typecode)
+        ids.frombytes(b"".join(map(
+            mul, map(units.__getitem__, indexes), lengths.tolist())))
+        if len(ids) != width * height:
+            raise Exception("tile runs cover {} cells, expected {}".format(
+                len(ids), width * height))
+
+    names = dict()
+    for i, tile_id in enumerate(palette):
+        names[i] = ids_to_names[tile_id]
+    return TileGrid(width, height, ids, names)
+
+
+def write_tile_runs(out, analysis):
+    """
+    Writes the tile grid as a palette of the dictionary ids it uses and
+    runs of equal cells in row order, or one palette index per cell when
+    that is smaller. See read_tile_runs.
+    """
+    palette = array(UINT_TYPECODE)
+    palette_indexes = dict()
+    runs = list()
+    for tile_id, run in groupby(analysis.tile_ids):
+        i = palette_indexes.get(tile_id)
+        if i == None:
+            i = len(palette)
+            palette_indexes[tile_id] = i
+            palette.append(tile_id)
+        runs.append((i, sum(1 for cell in run)))
+
+    typecode = palette_typecode(len(palette))
+    cells = array(typecode, [i for i, length in runs])
+    cell_count = len(analysis.tile_ids)
+    if len(runs) * (UINT.size + cells.itemsize) < cell_count * cells.itemsize:
+        out.pack(UINT2, len(palette), len(runs))
+        out.write_uints(palette)
+        out.write_uints(array(UINT_TYPECODE, [length for i, length in runs]))
+        out.write_array(typecode, cells)
+    else:
+        out.pack(UINT2, len(palette), 0)
+        out.write_uints(palette)
+        out.write_array(typecode, array(
+            typecode, [palette_indexes[tile_id] for tile_id in analysis.tile_ids]))
+
+
+def write_tile_chunks(index, data, analysis, width, height, encoding,
+                      level=None):
+    """
+    Writes the tile grid as chunks of TILE_CHUNK_SIZE square cells, each
+    compressed on its own, into data, and their positions into index.
+    See ChunkedTileGrid.
+    """
+    index.pack(UINT2, TILE_CHUNK_SIZE, TILE_CHUNK_SIZE)
+    index.pack(UINT, encoding)
+
+    ids = analysis.tile_ids
+    extents = array(UINT_TYPECODE)
+    for y0 in range(0, height, TILE_CHUNK_SIZE):
+        for x0 in range(0, width, TILE_CHUNK_SIZE):
+            x1 = min(x0 + TILE_CHUNK_SIZE, width)
+            chunk = FmpWriter((x1 - x0) * TILE_CHUNK_SIZE * UINT.size)
+            for y in range(y0, min(y0 + TILE_CHUNK_SIZE, height)):
+                chunk.write_uints(ids[y * width + x0:y * width + x1])
+
+            packed = compress(encoding, chunk.getbuffer(), level)
+            extents.append(data.pos)
+            extents.append(len(packed))
+            data.write_bytes(packed)
+    index.write_uints(extents)
 
 
 def write_layer(out, m, layer, layer_id, names_to_ids):
@@ -505,26 +1041,26 @@ def write_layer(out, m, layer, layer_id, names_to_ids):
     elif layer.isImageLayer():
         kind = 3
 
-    out.write(pack("II", layer_id, kind))
-    write_string(out, layer.name())
+    out.pack(UINT2, layer_id, kind)
+    out.write_string(layer.name())
     write_properties(out, layer, names_to_ids)
 
     if layer.isTileLayer():
         pass
     elif layer.isObjectGroup():
         objs = layer.asObjectGroup()
-        out.write(pack("I", objs.objectCount()))
+        out.pack(UINT, objs.objectCount())
         for i in range(objs.objectCount()):
             o = objs.objectAt(i)
             write_object(out, o, names_to_ids)
     elif layer.isGroupLayer():
         group = layer.asGroupLayer()
-        out.write(pack("I", group.layerCount()))
+        out.pack(UINT, group.layerCount())
         for i in range(group.layerCount()):
             found = False
             for j in range(m.layerCount()):
                 if m.layerAt(j) == group.layerAt(i):
-                    out.write(pack("I", j))
+                    out.pack(UINT, j)
                     found = True
                     break
             assert(found)
@@ -534,11 +1070,34 @@ def write_layer(out, m, layer, layer_id, names_to_ids):
         raise Exception("unknown layer kind")
 
 
+def iter_layers(fh, ids_to_names):
+    """
+    Yields the layers one at a time as they are decoded. The "objs" of
+    each layer is a generator that decodes its objects as they are used;
+    any left unread when the next layer is asked for are skipped.
+    """
+    layer_count = fh.read_uint()
+    for i in range(layer_count):
+        layer = read_layer(fh, ids_to_names)
+        yield layer
+        for o in layer["objs"]:
+            pass
+
+
+def iter_objects(fh, ids_to_names, obj_count):
+    for i in range(obj_count):
+        yield read_object(fh, ids_to_names)
+
+
 def read_layer(fh, ids_to_names):
-    layer_id, kind = unpack("II", fh.read(2 * 4))
-    name = read_string(fh)
+    """
+    Reads a layer up to its objects, which are left to the "objs"
+    generator. See iter_layers.
+    """
+    layer_id, kind = fh.unpack(UINT2)
+    name = fh.read_string()
     props = read_properties(fh, ids_to_names)
-    objs = list()
+    objs = iter(())
     group = list()
 
     if kind == 0:
@@ -546,16 +1105,13 @@ def read_layer(fh, ids_to_names):
         pass
     elif kind == 1:
         # object group
-        obj_count = unpack("I", fh.read(4))[0]
-        for i in range(obj_count):
-            o = read_object(fh, ids_to_names)
-            pprint(o)
-            objs.append(o)
+        obj_count = fh.read_uint()
+        objs = iter_objects(fh, ids_to_names, obj_count)
     elif kind == 2:
         # group layer
-        layer_count = unpack("I", fh.read(4))[0]
+        layer_count = fh.read_uint()
         for i in range(layer_count):
-            group.add(unpack("I", fh.read(4))[0])
+            group.append(fh.read_uint())
     elif kind == 3:
         # image layer
         pass
@@ -573,7 +1129,7 @@ def read_layer(fh, ids_to_names):
 
 
 def read_object(fh, ids_to_names):
-    data_id_id, data_type_id, name_id, x, y = unpack("IIIII", fh.read(4 * 5))
+    data_id_id, data_type_id, name_id, x, y = fh.unpack(OBJECT)
     data_id = ids_to_names[data_id_id]
     data_type = ids_to_names[data_type_id]
     name = ids_to_names[name_id]
@@ -601,8 +1157,8 @@ def write_object(out, obj, names_to_ids):
     # if obj.height() == 96:
     #     y += 1
 
-    out.write(pack("IIIII", names_to_ids[data_id],
-                   names_to_ids[data_type], names_to_ids[name], x, y))
+    out.pack(OBJECT, names_to_ids[data_id],
+             names_to_ids[data_type], names_to_ids[name], x, y)
 
     write_properties(out, obj, names_to_ids)
 
@@ -611,53 +1167,70 @@ def write_object(out, obj, names_to_ids):
     write_properties(out, obj.cell().tile(), names_to_ids)
 
 
-def find_tileset(m, data_type):
-    for i in range(m.tilesetCount()):
-        ts = m.tilesetAt(i).data()
-        if ts.name() == data_type:
-            return ts
-    return None
+class TileIndex():
+    """
+    data_id -> tile id for every tile of one tileset, built in a single
+    pass. Any data_id missing from it is known not to be in the tileset.
+    """
 
+    def __init__(self, tileset):
+        self.tileset = tileset
+        self.ids = dict()
+        for i in range(tileset.tileCount()):
+            tile = tileset.tileAt(i)
+            data_id = tile.propertyAsString("data_id")
+            # The first matching tile wins, as with a linear scan.
+            if not data_id in self.ids:
+                self.ids[data_id] = tile.id()
 
-def find_object_tile(tileset, data_id, cache):
-    if data_id in cache:
-        return tileset.tileAt(cache[data_id])
-    for i in range(tileset.tileCount()):
-        tile = tileset.tileAt(i)
-        if tile.propertyAsString("data_id") == data_id:
-            cache[data_id] = tile.id()
-            return tile
-    return None
+    def find(self, data_id):
+        tile_id = self.ids.get(data_id)
+        if tile_id == None:
+            return None
+        return self.tileset.tileAt(tile_id)
+
+
+def find_object_tile(tileset, data_id, indexes):
+    return tileset_index(tileset, indexes, TileIndex).find(data_id)
 
 
-def find_map_tile_across_all_tilesets(m, data_id):
-    cache = dict()
+def find_map_tile_across_all_tilesets(m, data_id, indexes=None):
+    if indexes == None:
+        indexes = dict()
     for i in range(m.tilesetCount()):
         ts = m.tilesetAt(i).data()
         if ts.name() == "core.map_chip":
-            tile = find_object_tile(ts, data_id, cache)
+            tile = find_object_tile(ts, data_id, indexes)
             if tile != None:
                 return tile
     return None
 
 
-def load_tiles(m, tile_layer, tiles):
-    cache = dict()
+def load_tiles(m, tile_layer, tiles, indexes):
     tileset = find_tileset(m, "core.map_chip")
     if tileset == None:
         raise Exception("No tileset loaded that has core.map_chip")
 
-    for y in range(m.height()):
-        for x in range(m.width()):
-            data_id = tiles[y * m.width() + x]
-            tile = find_object_tile(tileset, data_id, cache)
-            if tile == None:
-                raise Exception("Could not find tile " + data_id)
-            tile_layer.setCell(x, y, T.Tiled.Cell(tile))
-
-
-def load_objects(m, object_group, d):
-    cache = dict()
+    # Resolve each distinct tile once, then fill the layer from the ids.
+    # Chunked grids are read a band of rows at a time, so each chunk is
+    # decoded once.
+    cells = dict()
+    for y0, band in tiles.bands():
+        for tile_id in band.unique_ids():
+            if not tile_id in cells:
+                data_id = band.name(tile_id)
+                tile = find_object_tile(tileset, data_id, indexes)
+                if tile == None:
+                    raise Exception("Could not find tile " + data_id)
+                cells[tile_id] = T.Tiled.Cell(tile)
+
+        for y in range(band.height):
+            row = band.row(y)
+            for x in range(band.width):
+                tile_layer.setCell(x, y0 + y, cells[row[x]])
+
+
+def load_objects(m, object_group, d, indexes):
     tileset_cache = dict()
 
     for obj in d:
@@ -671,7 +1244,7 @@ def load_objects(m, object_group, d):
             raise Exception("No tileset loaded that has " + data_type)
         data_id = obj["data_id"]
         name = obj["name"]
-        tile = find_object_tile(tileset, data_id, cache)
+        tile = find_object_tile(tileset, data_id, indexes)
         if tile == None:
             raise Exception("No tileset loaded that has " +
                             data_type + "#" + data_id)
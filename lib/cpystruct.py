@@ -15,9 +15,18 @@
   You should have received a copy of the GNU General Public License
   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
+import keyword
+import mmap
 import re
 import sys
 import struct
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    # only needed for CpySkeleton.dtype() and CpyView.array()
+    numpy = None
 
 # struct.pack format characters prefixed by :
 REFMT = r':[@!<>=]?[0-9xcbBhHiIlLqQfdspP]+'
@@ -52,12 +61,18 @@ for f in FORMATS:
 class CpySkeleton(struct.Struct):
     """ Not to be used directly, use CpyStruct() to build a class """
 
+    def __init_subclass__(cls, **kws):
+        super().__init_subclass__(**kws)
+        # once per class rather than per instance; subclasses get their
+        # own, as they may add fromraw/fromval
+        cls.validate(cls)
+        cls._cpy_struct = struct.Struct(getattr(cls, '__fstr'))
+        cls._cpy_pack, cls._cpy_unpack, cls._cpy_record = compile_codec(cls)
+
     def __init__(self, dat=None, **kws):
         """ Takes keyword arguments to initialize attributes """
         struct.Struct.__init__(self, getattr(self, '__fstr'))
 
-        self.validate()
-
         if len(kws) > 0:
             for k in kws:
                 setattr(self, k, kws[k])
@@ -65,6 +80,79 @@ class CpySkeleton(struct.Struct):
         if dat != None:
             self.unpack(dat)
 
+    @classmethod
+    def unpack_many(cls, buf, count=None, offset=0, columns=False):
+        """
+        Decodes count consecutive records starting at offset in buf, or
+        as many whole records as it holds if count is None, in a single
+        pass with no per-record slicing. Returns a list of namedtuples of
+        the members, or with columns=True a dict of member name -> tuple
+        of that member's values. Layouts the generated code does not
+        handle are decoded into a list of instances instead.
+        """
+        size = cls._cpy_struct.size
+        view = memoryview(buf).cast('B')[offset:]
+        if count is None:
+            count = len(view) // size
+        elif len(view) < count * size:
+            raise struct.error('unpack_many requires a buffer of at least '
+                               '%i bytes' % (count * size))
+        view = view[:count * size]
+
+        names = [n for f, n, a, v in cls.formats]
+        if cls._cpy_record is None:
+            records = [cls(view[i * size:(i + 1) * size])
+                       for i in range(count)]
+            rows = [[getattr(r, n) for n in names] for r in records]
+        else:
+            records = list(map(cls._cpy_record,
+                               cls._cpy_struct.iter_unpack(view)))
+            rows = records
+
+        if not columns:
+            return records
+        if len(rows) == 0:
+            return dict((n, ()) for n in names)
+        return dict(zip(names, zip(*rows)))
+
+    @classmethod
+    def view(cls, buf, count=None, offset=0):
+        """
+        Returns a CpyView of count records at offset in buf (an mmap,
+        bytes, bytearray, ...), or of as many whole records as it holds.
+        Nothing is decoded until a member is read.
+        """
+        return CpyView(cls, buf, count, offset)
+
+    @classmethod
+    def map_view(cls, filename, count=None, offset=0):
+        """ Like view(), over a read-only mmap of filename """
+        with open(filename, 'rb') as fh:
+            buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        return CpyView(cls, buf, count, offset)
+
+    @classmethod
+    def dtype(cls):
+        """ The layout as a NumPy structured dtype; needs numpy """
+        if numpy is None:
+            raise Exception('numpy is not available')
+        names = []
+        formats = []
+        offsets = []
+        for name, offset, kind, codec, count in field_layout(cls):
+            names.append(name)
+            offsets.append(offset)
+            if kind == 'struct':
+                fmt = codec.dtype()
+            elif kind == 'bytes' or kind == 'str':
+                fmt = 'S%i' % codec.size
+            else:
+                fmt = numpy_format(codec.format)
+            formats.append(fmt if count == 0 else (fmt, (count,)))
+        return numpy.dtype({'names': names, 'formats': formats,
+                            'offsets': offsets,
+                            'itemsize': struct.calcsize(getattr(cls, '__fstr'))})
+
     def validate(self):
         "check that the extending classes specify valid struct"
 
@@ -77,7 +165,10 @@ class CpySkeleton(struct.Struct):
 
     def pack(self):
         "convert member values to binary"
-        ret = ''
+        if self._cpy_pack is not None:
+            return self._cpy_pack()
+
+        ret = b''
 
         for i, (f, n, a, v) in enumerate(self.formats):
             v = getattr(self, n)
@@ -125,6 +216,9 @@ class CpySkeleton(struct.Struct):
         """
         Takes a string, file, mmap or StringIO instance
         """
+        if self._cpy_unpack is not None:
+            return self._cpy_unpack(dat)
+
         rawpos = 0  # position in binary for custom types
         pos = 0  # in case substruct handles multiple values
 
@@ -168,9 +262,11 @@ class CpySkeleton(struct.Struct):
             if type(f) == type(struct.Struct):
                 sz = struct.calcsize(getattr(f, '__fstr'))
                 if arlen > 0:
+                    # views rather than copies of each element
+                    view = memoryview(buf).cast('B')
                     arr = []
                     for i in range(arlen):
-                        arr.append(f(buf[rawpos:rawpos+sz]))
+                        arr.append(f(view[rawpos:rawpos+sz]))
                         rawpos += sz
                         pos += len(f.formats)
                     setattr(self, n, arr)
@@ -223,7 +319,7 @@ class CpySkeleton(struct.Struct):
         return buf
 
     def __len__(self):
-        return struct.calcsize(getattr(self, '__fstr'))
+        return self.size
 
     def __str__(self):
         ret = self.__class__.__name__+'['
@@ -232,6 +328,250 @@ class CpySkeleton(struct.Struct):
         return ret[:-1]+']'
 
 
+def _encode(v):
+    return v.encode() if isinstance(v, str) else v
+
+
+def compile_codec(cls):
+    """
+    Generates pack and unpack functions specialized to the layout of
+    cls, each a single precompiled struct call with the fields assigned
+    in bulk, and a function that turns the values of one record into a
+    namedtuple for unpack_many. Returns Nones for layouts left to the
+    generic code: nested structs, variable-length arrays and
+    fromraw/fromval hooks.
+    """
+    formats = getattr(cls, 'formats', None)
+    if formats is None or hasattr(cls, 'fromraw') or hasattr(cls, 'fromval'):
+        return None, None, None
+
+    st = struct.Struct(getattr(cls, '__fstr'))
+    # expression for each member's value, given the unpacked tuple v
+    values = []
+    pack_args = []
+    bulk = True
+    pos = 0
+    for f, n, a, v in formats:
+        if type(f) == type(struct.Struct) or (a != '' and not a.isdigit()):
+            return None, None, None
+        if not n.isidentifier() or keyword.iskeyword(n) or n.startswith('_'):
+            return None, None, None
+        if a.isdigit() and f not in fdict:
+            return None, None, None
+
+        if a.isdigit() and fdict[f] != 'c':
+            arlen = int(a)
+            values.append('list(v[%i:%i])' % (pos, pos + arlen))
+            pack_args.append('*self.%s' % n)
+            pos += arlen
+            bulk = False
+        elif f.endswith('s'):
+            values.append('v[%i].decode()' % pos)
+            pack_args.append('_encode(self.%s)' % n)
+            pos += 1
+            bulk = False
+        elif a.isdigit():
+            # char array, kept as bytes
+            values.append('v[%i]' % pos)
+            pack_args.append('_encode(self.%s)' % n)
+            pos += 1
+        else:
+            values.append('v[%i]' % pos)
+            pack_args.append('self.%s' % n)
+            pos += 1
+
+    if pos != len(st.unpack(bytes(st.size))):
+        # formats such as ':2I' that yield several values per member
+        return None, None, None
+
+    names = [n for f, n, a, v in formats]
+    lines = [
+        'def unpack(self, dat):',
+        '    if hasattr(dat, "read") and callable(dat.read):',
+        '        buf = dat.read(%i)' % st.size,
+        '    else:',
+        '        buf = dat',
+    ]
+    if bulk and len(formats) > 0:
+        targets = ', '.join('self.%s' % n for n in names)
+        lines.append('    %s, = unpack_from(buf)' % targets)
+    else:
+        lines.append('    v = unpack_from(buf)')
+        lines.extend('    self.%s = %s' % (n, value)
+                     for n, value in zip(names, values))
+    lines.append('    return buf')
+    lines.append('def pack(self):')
+    lines.append('    return _pack(%s)' % ', '.join(pack_args))
+
+    record = namedtuple((cls.__name__ or 'Cpy') + 'Record', names)
+    if bulk:
+        lines.append('make = _record._make')
+    else:
+        lines.append('def make(v):')
+        lines.append('    return _record(%s)' % ', '.join(values))
+
+    scope = {'unpack_from': st.unpack_from, '_pack': st.pack,
+             '_encode': _encode, '_record': record}
+    exec('\n'.join(lines), scope)
+    return scope['pack'], scope['unpack'], scope['make']
+
+
+def field_layout(cls):
+    """
+    Returns (name, offset, kind, codec, count) for each member of cls,
+    where kind is 'value', 'list', 'str', 'bytes' or 'struct', codec is
+    the Struct of one element (the class itself for 'struct') and count
+    is the array length or 0. Cached per class.
+    """
+    layout = cls.__dict__.get('_cpy_layout')
+    if layout is not None:
+        return layout
+
+    endian = getattr(cls, '__endianflag')
+    fsz = getattr(cls, '__fsz')
+    if sum(fsz) != struct.calcsize(getattr(cls, '__fstr')):
+        raise Exception('views need a layout without padding: %s'
+                        % getattr(cls, '__fstr'))
+
+    layout = []
+    offset = 0
+    for i, (f, n, a, v) in enumerate(cls.formats):
+        if a != '' and not a.isdigit():
+            raise Exception('views do not support varlength arrays: %s[%s]'
+                            % (n, a))
+        count = int(a) if a.isdigit() else 0
+        if type(f) == type(struct.Struct):
+            layout.append((n, offset, 'struct', f, count))
+        elif f in fdict and fdict[f] == 'c' and count > 0:
+            layout.append((n, offset, 'bytes',
+                           struct.Struct('%s%is' % (endian, count)), 0))
+        elif f in fdict:
+            layout.append((n, offset, 'list' if count > 0 else 'value',
+                           struct.Struct(endian + fdict[f]), count))
+        elif count > 0:
+            st = struct.Struct(endian + f)
+            layout.append((n, offset, 'list', st, fsz[i] // st.size))
+        else:
+            layout.append((n, offset, 'str' if f.endswith('s') else 'value',
+                           struct.Struct(endian + f), 0))
+        offset += fsz[i]
+
+    cls._cpy_layout = layout
+    return layout
+
+
+def numpy_format(fmt):
+    """ NumPy equivalent of a single-value struct format such as '<I' """
+    endian = {'<': '<', '>': '>', '!': '>'}.get(fmt[0], '=')
+    code = fmt.lstrip('@=<>!')
+    size = struct.calcsize(fmt)
+    if code in 'bhilq':
+        return '%si%i' % (endian, size)
+    elif code in 'BHILQ':
+        return '%su%i' % (endian, size)
+    elif code in 'efd':
+        return '%sf%i' % (endian, size)
+    elif code == '?':
+        return '?'
+    elif code == 'c':
+        return 'S1'
+    raise Exception('no NumPy equivalent for ' + fmt)
+
+
+class CpyView(object):
+    """
+    Records of a CpyStruct class read in place from a buffer. Indexing
+    gives a CpyRecordView whose members are decoded from the underlying
+    bytes when read; column() decodes one member of every record in a
+    single pass. With numpy, array() is a structured array over the
+    same memory.
+    """
+
+    def __init__(self, cls, buf, count=None, offset=0):
+        self.cls = cls
+        self.layout = dict((field[0], field) for field in field_layout(cls))
+        self.size = struct.calcsize(getattr(cls, '__fstr'))
+        self.buf = buf
+        self.offset = offset
+        available = (len(memoryview(buf).cast('B')) - offset) // self.size
+        if count is None:
+            count = available
+        elif count > available:
+            raise struct.error('view of %i records needs %i bytes'
+                               % (count, offset + count * self.size))
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError('record index out of range')
+        return CpyRecordView(self, self.offset + i * self.size)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield CpyRecordView(self, self.offset + i * self.size)
+
+    def read(self, name, pos):
+        n, offset, kind, codec, count = self.layout[name]
+        pos += offset
+        if kind == 'struct':
+            sub = CpyView(codec, self.buf, max(count, 1), pos)
+            return list(sub) if count > 0 else sub[0]
+        elif kind == 'list':
+            return [codec.unpack_from(self.buf, pos + j * codec.size)[0]
+                    for j in range(count)]
+        v = codec.unpack_from(self.buf, pos)[0]
+        return v.decode() if kind == 'str' else v
+
+    def column(self, name):
+        """ One member of every record, decoded in a single pass """
+        n, offset, kind, codec, count = self.layout[name]
+        if kind == 'struct' or kind == 'list':
+            return [self.read(name, self.offset + i * self.size)
+                    for i in range(self.count)]
+        fmt = codec.format
+        if isinstance(fmt, bytes):
+            fmt = fmt.decode()
+        # the member with the rest of the record as padding
+        st = struct.Struct('%s%ix%s%ix' % (
+            fmt[0], offset, fmt[1:], self.size - offset - codec.size))
+        view = memoryview(self.buf).cast('B')[
+            self.offset:self.offset + self.count * self.size]
+        values = [v[0] for v in st.iter_unpack(view)]
+        if kind == 'str':
+            values = [v.decode() for v in values]
+        return values
+
+    def array(self):
+        """ A NumPy structured array over the buffer; needs numpy """
+        if numpy is None:
+            raise Exception('numpy is not available')
+        return numpy.frombuffer(self.buf, self.cls.dtype(), self.count,
+                                self.offset)
+
+
+class CpyRecordView(object):
+    """ One record of a CpyView, decoded member by member on access """
+    __slots__ = ('_view', '_pos')
+
+    def __init__(self, view, pos):
+        self._view = view
+        self._pos = pos
+
+    def __getattr__(self, name):
+        if not name in self._view.layout:
+            raise AttributeError(name)
+        return self._view.read(name, self._pos)
+
+    def __str__(self):
+        return '%s@%i[%s]' % (self._view.cls.__name__, self._pos, ','.join(
+            '%s=%s' % (n, getattr(self, n)) for n in self._view.layout))
+
+
 def peek(s, n):
     p = s.tell()
     r = s.read(n)
@@ -0,0 +1,139 @@
+"""
+Precompiled struct codecs for the fixed-width records of Elona map files,
+and buffers that read and write them by offset.
+
+All fields are little-endian with standard sizes and no padding, which
+is also what the x86 builds that wrote the existing files produced.
+"""
+
+import gzip
+import sys
+from array import array
+from struct import Struct
+
+BYTE = Struct("<b")
+UINT = Struct("<I")
+UINT2 = Struct("<II")
+
+# .fmp object: data_id, data_type and name dictionary ids, x, y
+OBJECT = Struct("<IIIII")
+
+# Typecode of the arrays holding uint32 runs such as the tile grid.
+UINT_TYPECODE = "I" if array("I").itemsize == UINT.size else "L"
+
+NATIVE_LITTLE_ENDIAN = sys.byteorder == "little"
+
+
+def uint_view(buf, pos, count):
+    """
+    Returns count uint32s starting at pos in buf. On little-endian hosts
+    this is a view into buf; elsewhere the values are copied and swapped.
+    """
+    data = memoryview(buf)[pos:pos + count * UINT.size]
+    if len(data) != count * UINT.size:
+        raise Exception("expected {} values at offset {}, file is too short".format(
+            count, pos))
+    if NATIVE_LITTLE_ENDIAN:
+        return data.cast(UINT_TYPECODE)
+    ids = array(UINT_TYPECODE)
+    ids.frombytes(data)
+    ids.byteswap()
+    return ids
+
+
+class FmpBuffer():
+    """
+    Cursor over a fully decompressed file. Fields are parsed by offset
+    instead of being read one at a time from the gzip stream.
+    """
+
+    def __init__(self, buf, pos=0):
+        self.buf = buf
+        self.pos = pos
+
+    @classmethod
+    def open(cls, f):
+        with gzip.open(f, "rb") as fh:
+            return FmpBuffer(fh.read())
+
+    def unpack(self, st):
+        vals = st.unpack_from(self.buf, self.pos)
+        self.pos += st.size
+        return vals
+
+    def read_byte(self):
+        return self.unpack(BYTE)[0]
+
+    def read_uint(self):
+        return self.unpack(UINT)[0]
+
+    def read_uints(self, count):
+        ids = uint_view(self.buf, self.pos, count)
+        self.pos += count * UINT.size
+        return ids
+
+    def read_array(self, typecode, count):
+        """Returns a copy of count little-endian values of the typecode."""
+        ids = array(typecode)
+        end = self.pos + count * ids.itemsize
+        if end > len(self.buf):
+            raise Exception("expected {} values at offset {}, file is too short".format(
+                count, self.pos))
+        ids.frombytes(self.buf[self.pos:end])
+        if not NATIVE_LITTLE_ENDIAN:
+            ids.byteswap()
+        self.pos = end
+        return ids
+
+    def read_string(self):
+        end = self.buf.find(b"\0", self.pos)
+        if end == -1:
+            raise Exception(
+                "unterminated string at offset {}".format(self.pos))
+        s = self.buf[self.pos:end].decode("ascii")
+        self.pos = end + 1
+        return s
+
+
+class FmpWriter():
+    """
+    Growable output buffer. Records are packed in place with pack_into,
+    and the result is handed to the compressor in one write.
+    """
+
+    def __init__(self, size=4096):
+        self.buf = bytearray(size)
+        self.pos = 0
+
+    def reserve(self, size):
+        end = self.pos + size
+        if end > len(self.buf):
+            self.buf.extend(bytes(max(end, 2 * len(self.buf)) - len(self.buf)))
+        return end
+
+    def pack(self, st, *vals):
+        end = self.reserve(st.size)
+        st.pack_into(self.buf, self.pos, *vals)
+        self.pos = end
+
+    def write_bytes(self, data):
+        data = memoryview(data).cast("B")
+        end = self.reserve(len(data))
+        self.buf[self.pos:end] = data
+        self.pos = end
+
+    def write_uints(self, ids):
+        self.write_array(UINT_TYPECODE, ids)
+
+    def write_array(self, typecode, ids):
+        if not NATIVE_LITTLE_ENDIAN:
+            ids = array(typecode, ids)
+            ids.byteswap()
+        self.write_bytes(ids)
+
+    def write_string(self, s):
+        self.write_bytes(s.encode())
+        self.pack(BYTE, 0)
+
+    def getbuffer(self):
+        return memoryview(self.buf)[:self.pos]
@@ -0,0 +1,162 @@
+"""
+Section container used by .fmp version 2 and later.
+
+Unlike version 1, which is one gzip stream, the container is a plain
+file that starts with a table of sections:
+
+    magic "FMP ", version, section count     (PREAMBLE)
+    tag, encoding, offset, length, raw length (SECTION, once per section)
+
+Every section starts on an ALIGNMENT boundary. Sections stored with
+ENCODING_RAW can be used straight out of an mmap of the file; the
+others are decompressed when read, using the encoding recorded in the
+section table.
+"""
+
+import mmap
+import os
+import zlib
+from struct import Struct
+
+try:
+    import lzma
+except ImportError:
+    # Not every Python build that Tiled embeds has it.
+    lzma = None
+
+MAGIC = b"FMP "
+PREAMBLE = Struct("<4sII")
+SECTION = Struct("<4sIQQQ")
+ALIGNMENT = 16
+
+ENCODING_RAW = 0
+ENCODING_ZLIB = 1
+ENCODING_LZMA = 2
+
+ENCODINGS = {
+    "none": ENCODING_RAW,
+    "zlib": ENCODING_ZLIB,
+    "lzma": ENCODING_LZMA,
+}
+
+
+def is_container(f):
+    with open(f, "rb") as fh:
+        return fh.read(len(MAGIC)) == MAGIC
+
+
+def align(pos):
+    return (pos + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def compress(encoding, data, level=None):
+    if encoding == ENCODING_RAW:
+        return data
+    elif encoding == ENCODING_ZLIB:
+        # Z_RLE and Z_FILTERED do not help here: the grids repeat 4 byte
+        # ids, which Z_RLE (distance 1 matches only) cannot use.
+        c = zlib.compressobj(9 if level == None else level,
+                             zlib.DEFLATED, zlib.MAX_WBITS, 9)
+        return c.compress(data) + c.flush()
+    elif encoding == ENCODING_LZMA:
+        if lzma == None:
+            raise Exception("lzma is not available in this Python")
+        return lzma.compress(data, preset=6 if level == None else level)
+    raise Exception("unknown section encoding " + str(encoding))
+
+
+def decompress(encoding, data, raw_length):
+    if encoding == ENCODING_RAW:
+        return data
+    elif encoding == ENCODING_ZLIB:
+        raw = zlib.decompress(data)
+    elif encoding == ENCODING_LZMA:
+        if lzma == None:
+            raise Exception("lzma is not available in this Python")
+        raw = lzma.decompress(data)
+    else:
+        raise Exception("unknown section encoding " + str(encoding))
+    if len(raw) != raw_length:
+        raise Exception("section decompressed to {} bytes, expected {}".format(
+            len(raw), raw_length))
+    return raw
+
+
+class Section():
+    def __init__(self, tag, encoding, data, raw_length=None):
+        self.tag = tag
+        self.encoding = encoding
+        self.data = memoryview(data).cast("B")
+        self.raw_length = len(self.data) if raw_length == None else raw_length
+
+    @classmethod
+    def encode(cls, tag, encoding, data, level=None):
+        data = memoryview(data).cast("B")
+        return Section(tag, encoding, compress(encoding, data, level), len(data))
+
+
+def write_container(filename, version, sections):
+    pos = align(PREAMBLE.size + SECTION.size * len(sections))
+    table = bytearray(pos)
+    PREAMBLE.pack_into(table, 0, MAGIC, version, len(sections))
+
+    offsets = list()
+    for i, section in enumerate(sections):
+        offsets.append(pos)
+        SECTION.pack_into(table, PREAMBLE.size + SECTION.size * i,
+                          section.tag, section.encoding, pos,
+                          len(section.data), section.raw_length)
+        pos = align(pos + len(section.data))
+
+    with open(filename, "wb") as fh:
+        fh.write(table)
+        for pos, section in zip(offsets, sections):
+            fh.seek(pos)
+            fh.write(section.data)
+        fh.truncate(align(fh.tell()))
+
+
+class Container():
+    """
+    Sections of a container file, read in place through an mmap. Only
+    the pages of the sections that are used get read from disk.
+    """
+
+    def __init__(self, f):
+        with open(f, "rb") as fh:
+            if os.fstat(fh.fileno()).st_size < PREAMBLE.size:
+                raise Exception("not an .fmp container: " + str(f))
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.version, count = PREAMBLE.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise Exception("not an .fmp container: " + str(f))
+
+        # tag -> (encoding, offset, length, raw length)
+        self.sections = dict()
+        for i in range(count):
+            tag, encoding, offset, length, raw_length = SECTION.unpack_from(
+                self.map, PREAMBLE.size + SECTION.size * i)
+            if offset + length > len(self.map):
+                raise Exception("section {} of {} is truncated".format(
+                    tag.decode("ascii", "replace"), f))
+            self.sections[tag] = (encoding, offset, length, raw_length)
+
+    def encoding(self, tag):
+        return self.sections[tag][0]
+
+    def section(self, tag):
+        """Returns the stored bytes of a section as a view into the file."""
+        if not tag in self.sections:
+            raise Exception("missing section " + tag.decode("ascii"))
+        encoding, offset, length, raw_length = self.sections[tag]
+        return memoryview(self.map)[offset:offset + length]
+
+    def data(self, tag):
+        """
+        Returns the contents of a section: the stored bytes for raw
+        sections, decompressed bytes otherwise.
+        """
+        stored = self.section(tag)
+        encoding, offset, length, raw_length = self.sections[tag]
+        return decompress(encoding, stored, raw_length)
@@ -0,0 +1,79 @@
+"""
+Content-hash manifest for incremental map conversion.
+
+For every output map the manifest records the input it was written from
+and a key, a digest of everything the output was built from. A later
+run can skip any map written from the same input whose key is
+unchanged. File digests are cached by mtime and size, so an unchanged
+file is only hashed once.
+"""
+
+import hashlib
+import json
+import os
+from os.path import exists, join, realpath
+
+MANIFEST_NAME = ".fmp-manifest.json"
+
+
+class Manifest():
+    def __init__(self, directory):
+        self.path = join(directory, MANIFEST_NAME)
+        # realpath -> [mtime, size, sha1]
+        self.files = dict()
+        # output file name -> [input realpath, key]
+        self.outputs = dict()
+        self.changed = False
+
+        if exists(self.path):
+            try:
+                with open(self.path, "r") as fh:
+                    data = json.load(fh)
+                self.files = data["files"]
+                self.outputs = data["outputs"]
+            except (ValueError, KeyError):
+                # Unreadable manifests only cost a full rebuild.
+                pass
+
+    def file_digest(self, filename):
+        path = realpath(filename)
+        st = os.stat(path)
+        entry = self.files.get(path)
+        if entry != None and entry[0] == st.st_mtime and entry[1] == st.st_size:
+            return entry[2]
+
+        h = hashlib.sha1()
+        with open(path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1 << 16), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        self.files[path] = [st.st_mtime, st.st_size, digest]
+        self.changed = True
+        return digest
+
+    def key(self, filenames, salt=""):
+        """Combines the digests of filenames, in order, into one key."""
+        h = hashlib.sha1(salt.encode())
+        for filename in filenames:
+            h.update(self.file_digest(filename).encode())
+        return h.hexdigest()
+
+    def is_current(self, f, out, key):
+        # An output written from another input is not current, even if
+        # that input's key matched.
+        return exists(out) and \
+            self.outputs.get(os.path.basename(out)) == [realpath(f), key]
+
+    def record(self, f, out, key):
+        self.outputs[os.path.basename(out)] = [realpath(f), key]
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as fh:
+            json.dump({"files": self.files, "outputs": self.outputs},
+                      fh, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+        self.changed = False
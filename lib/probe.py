@@ -0,0 +1,53 @@
+"""
+Cheap checks on gzip'd map files that inflate only the start of the file.
+"""
+
+import os
+import zlib
+
+GZIP_MAGIC = b"\x1f\x8b"
+CHUNK_SIZE = 16 * 1024
+
+
+def read_head(filename, size):
+    """
+    Returns up to size inflated bytes from the start of a gzip file, or
+    None if the file is not gzip'd.
+    """
+    with open(filename, "rb") as fh:
+        data = fh.read(CHUNK_SIZE)
+        if data[:2] != GZIP_MAGIC:
+            return None
+
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        head = bytearray()
+        try:
+            while data and len(head) < size:
+                head += d.decompress(data, size - len(head))
+                data = d.unconsumed_tail or fh.read(CHUNK_SIZE)
+        except zlib.error:
+            return None
+        return bytes(head)
+
+
+def memoized(probe):
+    """
+    Caches the result of probe(filename) until the file's mtime changes.
+    A file that cannot be stat'ed probes as None.
+    """
+    results = dict()
+
+    def cached_probe(filename):
+        try:
+            mtime = os.stat(filename).st_mtime
+        except OSError:
+            return None
+        entry = results.get(filename)
+        if entry != None and entry[0] == mtime:
+            return entry[1]
+        result = probe(filename)
+        results[filename] = (mtime, result)
+        return result
+
+    cached_probe.results = results
+    return cached_probe
@@ -0,0 +1,360 @@
+"""
+In-memory stand-in for the parts of Tiled's Python API used by the map
+plugins, so maps can be converted without running Tiled.
+
+The plugins import this module as T when the tiled module is not
+available. It covers orthogonal maps with tile layers, object groups and
+group layers, and loads tilesets from .tsx files.
+"""
+
+from xml.etree import ElementTree
+
+
+def qt_string(value):
+    # Matches QVariant::toString() for the value types the plugins set.
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Object():
+    def __init__(self):
+        self.props = dict()
+
+    def setProperty(self, name, value):
+        self.props[name] = value
+
+    def properties(self):
+        # Tiled's Properties is a QMap, whose keys come back sorted. The
+        # plugins write properties in that order.
+        return dict(sorted(self.props.items()))
+
+    def propertyAsString(self, name):
+        if not name in self.props:
+            return ""
+        return qt_string(self.props[name])
+
+    def propertyType(self, name):
+        value = self.props.get(name)
+        if isinstance(value, bool):
+            return "bool"
+        elif isinstance(value, int):
+            return "int"
+        elif isinstance(value, float):
+            return "float"
+        return "string"
+
+
+class Tile(Object):
+    def __init__(self, tile_id, tile_type, width, height):
+        Object.__init__(self)
+        self.tile_id = tile_id
+        self.tile_type = tile_type
+        self.w = width
+        self.h = height
+
+    def id(self):
+        return self.tile_id
+
+    def type(self):
+        return self.tile_type
+
+    def width(self):
+        return self.w
+
+    def height(self):
+        return self.h
+
+
+class Tileset(Object):
+    def __init__(self, name, tile_width, tile_height):
+        Object.__init__(self)
+        self.tileset_name = name
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.tiles = dict()
+
+    def name(self):
+        return self.tileset_name
+
+    def tileCount(self):
+        return len(self.tiles)
+
+    def tileAt(self, tile_id):
+        return self.tiles.get(tile_id)
+
+    def addTile(self, tile):
+        self.tiles[tile.id()] = tile
+
+    def data(self):
+        # Tiled hands out tilesets wrapped in a SharedTileset.
+        return self
+
+
+PROPERTY_TYPES = {
+    "int": int,
+    "float": float,
+    "bool": lambda s: s == "true",
+}
+
+
+def loadTileset(filename):
+    root = ElementTree.parse(filename).getroot()
+    tile_width = int(root.get("tilewidth", 0))
+    tile_height = int(root.get("tileheight", 0))
+    tileset = Tileset(root.get("name", ""), tile_width, tile_height)
+
+    for elem in root.findall("tile"):
+        width, height = tile_width, tile_height
+        image = elem.find("image")
+        if image != None:
+            width = int(image.get("width", width))
+            height = int(image.get("height", height))
+
+        tile = Tile(int(elem.get("id")), elem.get("type", ""), width, height)
+        for prop in elem.iter("property"):
+            value = prop.get("value", prop.text or "")
+            convert = PROPERTY_TYPES.get(prop.get("type"), str)
+            tile.setProperty(prop.get("name"), convert(value))
+        tileset.addTile(tile)
+
+    return tileset
+
+
+class Cell():
+    def __init__(self, tile=None):
+        self.t = tile
+
+    def tile(self):
+        return self.t
+
+
+class Layer(Object):
+    def __init__(self, name):
+        Object.__init__(self)
+        self.layer_name = name
+
+    def name(self):
+        return self.layer_name
+
+    def isTileLayer(self):
+        return False
+
+    def isObjectGroup(self):
+        return False
+
+    def isGroupLayer(self):
+        return False
+
+    def isImageLayer(self):
+        return False
+
+    def asTileLayer(self):
+        return self
+
+    def asObjectGroup(self):
+        return self
+
+    def asGroupLayer(self):
+        return self
+
+
+class TileLayer(Layer):
+    def __init__(self, name, x, y, width, height):
+        Layer.__init__(self, name)
+        self.w = width
+        self.h = height
+        self.tiles = [None] * (width * height)
+
+    def isTileLayer(self):
+        return True
+
+    def width(self):
+        return self.w
+
+    def height(self):
+        return self.h
+
+    def cellAt(self, x, y):
+        if x < 0 or y < 0 or x >= self.w or y >= self.h:
+            return Cell()
+        return Cell(self.tiles[y * self.w + x])
+
+    def setCell(self, x, y, cell):
+        self.tiles[y * self.w + x] = cell.tile()
+
+    def isEmpty(self):
+        for tile in self.tiles:
+            if tile != None:
+                return False
+        return True
+
+
+class ObjectGroup(Layer):
+    def __init__(self, name, x, y):
+        Layer.__init__(self, name)
+        self.objects = list()
+
+    def isObjectGroup(self):
+        return True
+
+    def objectCount(self):
+        return len(self.objects)
+
+    def objectAt(self, i):
+        return self.objects[i]
+
+    def addObject(self, obj):
+        self.objects.append(obj)
+
+
+class GroupLayer(Layer):
+    def __init__(self, name, x, y):
+        Layer.__init__(self, name)
+        self.layers = list()
+
+    def isGroupLayer(self):
+        return True
+
+    def layerCount(self):
+        return len(self.layers)
+
+    def layerAt(self, i):
+        return self.layers[i]
+
+    def addLayer(self, layer):
+        self.layers.append(layer)
+
+
+class MapObject(Object):
+    def __init__(self, name, object_type, pos, size):
+        Object.__init__(self)
+        self.object_name = name
+        self.object_type = object_type
+        self.pos = pos
+        self.size = size
+        self.c = Cell()
+
+    def name(self):
+        return self.object_name
+
+    def setType(self, object_type):
+        self.object_type = object_type
+
+    def effectiveType(self):
+        # Objects without a type of their own take the type of their tile.
+        if self.object_type == "" and self.c.tile() != None:
+            return self.c.tile().type()
+        return self.object_type
+
+    def setCell(self, cell):
+        self.c = cell
+
+    def cell(self):
+        return self.c
+
+    def x(self):
+        return self.pos.x()
+
+    def y(self):
+        return self.pos.y()
+
+    def width(self):
+        return self.size.width()
+
+    def height(self):
+        return self.size.height()
+
+
+class Map(Object):
+    Orthogonal = 1
+    RightDown = 0
+
+    def __init__(self, orientation, width, height, tile_width, tile_height):
+        Object.__init__(self)
+        self.orientation = orientation
+        self.render_order = Map.RightDown
+        self.infinite = False
+        self.w = width
+        self.h = height
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.layers = list()
+        self.tilesets = list()
+
+    def width(self):
+        return self.w
+
+    def height(self):
+        return self.h
+
+    def setInfinite(self, infinite):
+        self.infinite = infinite
+
+    def setOrientation(self, orientation):
+        self.orientation = orientation
+
+    def setRenderOrder(self, render_order):
+        self.render_order = render_order
+
+    def addTileset(self, tileset):
+        self.tilesets.append(tileset)
+
+    def tilesetCount(self):
+        return len(self.tilesets)
+
+    def tilesetAt(self, i):
+        return self.tilesets[i]
+
+    def addLayer(self, layer):
+        self.layers.append(layer)
+
+    def layerCount(self):
+        return len(self.layers)
+
+    def layerAt(self, i):
+        return self.layers[i]
+
+
+class Plugin():
+    pass
+
+
+class Tiled():
+    Map = Map
+    TileLayer = TileLayer
+    ObjectGroup = ObjectGroup
+    GroupLayer = GroupLayer
+    MapObject = MapObject
+    Cell = Cell
+
+
+class QPointF():
+    def __init__(self, x, y):
+        self.px = x
+        self.py = y
+
+    def x(self):
+        return self.px
+
+    def y(self):
+        return self.py
+
+
+class QSizeF():
+    def __init__(self, width, height):
+        self.w = width
+        self.h = height
+
+    def width(self):
+        return self.w
+
+    def height(self):
+        return self.h
+
+
+class qt():
+    QPointF = QPointF
+    QSizeF = QSizeF
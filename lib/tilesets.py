@@ -0,0 +1,151 @@
+"""
+Tileset loading shared by the Elona map plugins.
+
+Loaded tilesets are kept for the whole process and reused as long as
+the file on disk has not changed. Tilesets other than the map atlas can
+be left out when a map is opened; find_tileset loads them the first
+time they are asked for.
+"""
+
+import os
+from os.path import exists, join, realpath
+from xml.etree import ElementTree
+try:
+    import tiled as T
+except ImportError:
+    # Running outside of Tiled, e.g. from convert.py.
+    from lib import tiled_model as T
+
+# realpath -> (mtime, size, tileset)
+loaded_tilesets = dict()
+
+# realpath -> (mtime, size, tileset name)
+tileset_names = dict()
+
+# tileset name (data_type) -> realpath, for the non-atlas tilesets of
+# every directory scanned so far
+tileset_paths = dict()
+
+
+def get_tileset(filename):
+    path = realpath(filename)
+    if not exists(path):
+        raise Exception("cannot find tileset file " + filename)
+
+    st = os.stat(path)
+    entry = loaded_tilesets.get(path)
+    if entry != None and entry[0] == st.st_mtime and entry[1] == st.st_size:
+        return entry[2]
+
+    print("load " + filename)
+    tileset = T.loadTileset(path)
+    if tileset == None:
+        raise Exception("failed to load " + filename)
+    loaded_tilesets[path] = (st.st_mtime, st.st_size, tileset)
+    return tileset
+
+
+def load_tileset(m, filename):
+    m.addTileset(get_tileset(filename))
+
+
+def read_tileset_name(filename):
+    """
+    Reads the name of a tileset from its root element without parsing
+    the rest of the file.
+    """
+    path = realpath(filename)
+    st = os.stat(path)
+    entry = tileset_names.get(path)
+    if entry != None and entry[0] == st.st_mtime and entry[1] == st.st_size:
+        return entry[2]
+
+    name = None
+    for event, elem in ElementTree.iterparse(path, events=("start",)):
+        name = elem.get("name")
+        break
+    tileset_names[path] = (st.st_mtime, st.st_size, name)
+    return name
+
+
+def scan_tilesets(tileset_directory):
+    """
+    Returns (path, name) for each non-atlas tileset in the directory and
+    remembers where each name can be loaded from.
+    """
+    found = list()
+    for filename in sorted(os.listdir(tileset_directory)):
+        if filename == "map0.tsx" or filename == "map1.tsx" or filename == "map2.tsx":
+            continue
+        if filename.endswith(".tsx"):
+            path = realpath(join(tileset_directory, filename))
+            name = read_tileset_name(path)
+            tileset_paths[name] = path
+            found.append((path, name))
+    return found
+
+
+def load_tilesets(m, atlas, directory, data_types=None):
+    """
+    Adds the map_chip tileset for atlas and the other tilesets found in
+    directory to the map. If data_types is given, only tilesets named in
+    it are added now and the rest are left to find_tileset.
+    """
+    tileset_directory = join(directory, "Elona_foobar")
+
+    tile_atlas = join(tileset_directory, "map%01i.tsx" % atlas)
+    load_tileset(m, tile_atlas)
+
+    for path, name in scan_tilesets(tileset_directory):
+        if data_types == None or name in data_types:
+            load_tileset(m, path)
+
+
+def preload_tilesets(directory, data_types=None):
+    """
+    Loads the atlases and the other tilesets in directory into the cache
+    without adding them to a map. As with load_tilesets, if data_types
+    is given only tilesets named in it are loaded besides the atlases.
+    """
+    tileset_directory = join(directory, "Elona_foobar")
+    for atlas in range(3):
+        tile_atlas = join(tileset_directory, "map%01i.tsx" % atlas)
+        if exists(tile_atlas):
+            get_tileset(tile_atlas)
+    for path, name in scan_tilesets(tileset_directory):
+        if data_types == None or name in data_types:
+            get_tileset(path)
+
+
+def find_loaded_tileset(m, data_type):
+    for i in range(m.tilesetCount()):
+        ts = m.tilesetAt(i).data()
+        if ts.name() == data_type:
+            return ts
+    return None
+
+
+def find_tileset(m, data_type):
+    ts = find_loaded_tileset(m, data_type)
+    if ts == None and data_type in tileset_paths:
+        # Left out when the map was opened, load it now.
+        load_tileset(m, tileset_paths[data_type])
+        ts = find_loaded_tileset(m, data_type)
+    return ts
+
+
+def tileset_index(tileset, indexes, build):
+    """
+    Returns the index build(tileset) made for tileset, building it the
+    first time. indexes is the caller's cache; an index type is built
+    once per tileset for as long as the cache is kept.
+    """
+    # Indexes are keyed by tileset identity. Each entry keeps its
+    # tileset alive as index.tileset, so the id cannot be reused by
+    # another one.
+    key = (build, id(tileset))
+    index = indexes.get(key)
+    if index == None or index.tileset is not tileset:
+        index = build(tileset)
+        indexes[key] = index
+    return index